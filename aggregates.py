@@ -0,0 +1,318 @@
+""" Single-pass aggregation of a loaded bikeshare DataFrame.
+
+    BikeshareAggregates collects everything the statistics menu needs - counts
+    per month/weekday/hour, per start/end station and per trip, trip duration
+    totals and the user type/gender/birth year counts - in one vectorized pass
+    over the data. time_stats, station_stats, trip_duration_stats and
+    user_stats in bikeshare.py only read from it, so switching between menu
+    items does not touch the row-level data again.
+"""
+import calendar
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import instrument
+import store
+from odmatrix import ODMatrix
+
+NS_PER_HOUR = 3600 * 10**9
+
+
+def _category_codes(series, vocabulary):
+    """ Returns integer codes of a text column with respect to a list of names (-1 for missing values). """
+    cat = series.array if isinstance(series.dtype, pd.CategoricalDtype) else pd.Categorical(series)
+    position = {name: i for i, name in enumerate(vocabulary)}
+    lookup = np.array([position[c] for c in cat.categories] + [-1], dtype=np.int64)
+    return lookup[np.asarray(cat.codes)]
+
+
+def _categories(series):
+    """ Returns the distinct non-missing values of a text column. """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return [str(c) for c in series.cat.categories]
+    return sorted(str(c) for c in series.dropna().unique())
+
+
+def _value_counts(series):
+    """ Counts the non-missing values of a text column, returns a dict name -> count. """
+    cat = series.array if isinstance(series.dtype, pd.CategoricalDtype) else pd.Categorical(series)
+    codes = np.asarray(cat.codes)
+    counts = np.bincount(codes[codes >= 0], minlength=len(cat.categories))
+    return {str(name): int(n) for name, n in zip(cat.categories, counts) if n > 0}
+
+
+def _top(counts):
+    """ Returns (position, count) of the largest entry of a count array, first one on ties. """
+    i = int(np.argmax(counts))
+    return i, int(counts[i])
+
+
+def _merge_counts(first, second):
+    """ Adds up two count maps, None stands for 'not available' (e.g. no gender column). """
+    if first is None or second is None:
+        return second if first is None else first
+    merged = dict(first)
+    for key, n in second.items():
+        merged[key] = merged.get(key, 0) + n
+    return dict(sorted(merged.items()))
+
+
+class BikeshareAggregates:
+    """ Counts, sums and extremes of a (filtered) bikeshare DataFrame, computed in one pass.
+        Stations are referred to by their position in self.stations, which is
+        shared by the start and end station counts and the trip counts.
+    """
+    __slots__ = ('trips', 'month_counts', 'weekday_counts', 'hour_counts', 'stations', 'start_counts',
+                 'end_counts', 'od', 'duration_count', 'duration_sum', 'duration_max', 'user_types',
+                 'genders', 'birth_years')
+
+    def __init__(self):
+        self.trips = 0
+        # month_counts[1...12], weekday_counts[0 = Monday ... 6], hour_counts[0...23]
+        self.month_counts = np.zeros(13, dtype=np.int64)
+        self.weekday_counts = np.zeros(7, dtype=np.int64)
+        self.hour_counts = np.zeros(24, dtype=np.int64)
+        self.stations = []
+        self.start_counts = np.zeros(0, dtype=np.int64)
+        self.end_counts = np.zeros(0, dtype=np.int64)
+        # sparse origin-destination counts on the station positions
+        self.od = ODMatrix.empty()
+        self.duration_count = 0
+        self.duration_sum = 0.0
+        self.duration_max = None
+        self.user_types = {}
+        self.genders = None
+        self.birth_years = None
+
+    @classmethod
+    def from_frame(cls, df):
+        """ Computes the aggregates of a DataFrame as returned by load_data.
+            Args:
+                df - Pandas DataFrame containing filtered or unfiltered dataset
+            Returns:
+                BikeshareAggregates
+        """
+        with instrument.stage('aggregate', rows=len(df)):
+            return cls._from_frame(df)
+
+    @classmethod
+    def _from_frame(cls, df):
+        agg = cls()
+        agg.trips = len(df)
+        if agg.trips == 0:
+            return agg
+
+        # times of travel - integer codes straight from datetime64 values
+        start_times = np.asarray(df['Start Time'], dtype='datetime64[ns]')
+        month, weekday = store.time_codes(start_times)
+        hour = (start_times.view(np.int64) // NS_PER_HOUR) % 24
+        agg.month_counts = np.bincount(month, minlength=13).astype(np.int64)
+        agg.weekday_counts = np.bincount(weekday, minlength=7).astype(np.int64)
+        agg.hour_counts = np.bincount(hour, minlength=24).astype(np.int64)
+
+        # stations and trips on one shared station vocabulary
+        agg.stations = sorted(set(_categories(df['Start Station'])) | set(_categories(df['End Station'])))
+        n_stations = len(agg.stations)
+        start = _category_codes(df['Start Station'], agg.stations)
+        end = _category_codes(df['End Station'], agg.stations)
+        agg.start_counts = np.bincount(start[start >= 0], minlength=n_stations).astype(np.int64)
+        agg.end_counts = np.bincount(end[end >= 0], minlength=n_stations).astype(np.int64)
+        valid = (start >= 0) & (end >= 0)
+        agg.od = ODMatrix.from_coo(start[valid], end[valid], n_stations)
+
+        # trip duration
+        duration = df['Trip Duration'].to_numpy(dtype=np.float64, na_value=np.nan)
+        duration = duration[~np.isnan(duration)]
+        agg.duration_count = len(duration)
+        if agg.duration_count:
+            agg.duration_sum = float(duration.sum())
+            agg.duration_max = float(duration.max())
+
+        # users - gender and year of birth are not available for every city
+        agg.user_types = _value_counts(df['User Type'])
+        if 'Gender' in df.columns:
+            agg.genders = _value_counts(df['Gender'])
+        if 'Birth Year' in df.columns:
+            years = df['Birth Year'].to_numpy(dtype=np.float64, na_value=np.nan)
+            years, counts = np.unique(years[~np.isnan(years)].astype(np.int64), return_counts=True)
+            agg.birth_years = dict(zip(years.tolist(), counts.tolist()))
+        return agg
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """ Computes the aggregates chunk by chunk, e.g. over load_data(..., chunksize=n).
+            Memory stays bounded by one chunk plus the aggregate state.
+            Args:
+                chunks - iterable of Pandas DataFrames
+            Returns:
+                BikeshareAggregates - identical to from_frame on all chunks concatenated
+        """
+        agg = cls()
+        for chunk in chunks:
+            agg = agg.merge(cls.from_frame(chunk))
+        return agg
+
+    def merge(self, other):
+        """ Combines the aggregates of two disjoint parts of the data.
+            Args:
+                other - BikeshareAggregates of the other part
+            Returns:
+                BikeshareAggregates - new object, self and other stay unchanged
+        """
+        if other.trips == 0:
+            return self
+        if self.trips == 0:
+            return other
+        agg = BikeshareAggregates()
+        agg.trips = self.trips + other.trips
+        agg.month_counts = self.month_counts + other.month_counts
+        agg.weekday_counts = self.weekday_counts + other.weekday_counts
+        agg.hour_counts = self.hour_counts + other.hour_counts
+
+        # move both sides onto the union of their station vocabularies
+        agg.stations = sorted(set(self.stations) | set(other.stations))
+        position = {name: i for i, name in enumerate(agg.stations)}
+        n_stations = len(agg.stations)
+        agg.start_counts = np.zeros(n_stations, dtype=np.int64)
+        agg.end_counts = np.zeros(n_stations, dtype=np.int64)
+        agg.od = ODMatrix.empty(n_stations)
+        for part in (self, other):
+            ids = np.array([position[name] for name in part.stations], dtype=np.int64)
+            np.add.at(agg.start_counts, ids, part.start_counts)
+            np.add.at(agg.end_counts, ids, part.end_counts)
+            agg.od = agg.od.merge(part.od.relabel(ids, n_stations))
+
+        agg.duration_count = self.duration_count + other.duration_count
+        agg.duration_sum = self.duration_sum + other.duration_sum
+        maxima = [m for m in (self.duration_max, other.duration_max) if m is not None]
+        agg.duration_max = max(maxima) if maxima else None
+
+        agg.user_types = _merge_counts(self.user_types, other.user_types)
+        agg.genders = _merge_counts(self.genders, other.genders)
+        agg.birth_years = _merge_counts(self.birth_years, other.birth_years)
+        return agg
+
+    # --- persistence
+    def save(self, path, sources=None):
+        """ Writes the aggregates as .npz (count arrays, OD matrix) plus a .json file.
+            Both files are replaced in one step each and carry the same random
+            token, so a pair left over by an interrupted save is never read.
+            Args:
+                (str) path - file name without extension
+                sources - optional description of the data the aggregates cover
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        token = os.urandom(8).hex()
+        store.write_atomic(path + '.npz', lambda f: np.savez(
+            f, token=token, month_counts=self.month_counts, weekday_counts=self.weekday_counts,
+            hour_counts=self.hour_counts, start_counts=self.start_counts, end_counts=self.end_counts,
+            od_indptr=self.od.indptr, od_indices=self.od.indices, od_data=self.od.data), binary=True)
+        # JSON object keys are strings - years of birth are stored as pairs
+        meta = {'token': token, 'trips': self.trips, 'stations': self.stations, 'duration_count': self.duration_count,
+                'duration_sum': self.duration_sum, 'duration_max': self.duration_max,
+                'user_types': self.user_types, 'genders': self.genders,
+                'birth_years': None if self.birth_years is None else list(self.birth_years.items()),
+                'sources': sources}
+        store.write_atomic(path + '.json', lambda f: json.dump(meta, f))
+
+    @classmethod
+    def load(cls, path):
+        """ Reads aggregates written by save().
+            Returns:
+                BikeshareAggregates and the sources they were saved with, (None, None) if unreadable
+        """
+        agg = cls()
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            with np.load(path + '.npz') as arrays:
+                if str(arrays['token']) != meta['token']:
+                    return None, None
+                for name in ('month_counts', 'weekday_counts', 'hour_counts', 'start_counts', 'end_counts'):
+                    setattr(agg, name, arrays[name])
+                agg.stations = meta['stations']
+                agg.od = ODMatrix(len(agg.stations), arrays['od_indptr'], arrays['od_indices'], arrays['od_data'])
+            for name in ('trips', 'duration_count', 'duration_sum', 'duration_max', 'user_types', 'genders'):
+                setattr(agg, name, meta[name])
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None, None
+        if meta['birth_years'] is not None:
+            agg.birth_years = {year: n for year, n in meta['birth_years']}
+        return agg, meta['sources']
+
+    # --- times of travel
+    def popular_month(self):
+        """ Returns name and count of the most common month. """
+        i, n = _top(self.month_counts)
+        return calendar.month_name[i], n
+
+    def popular_weekday(self):
+        """ Returns name and count of the most common day of the week. """
+        i, n = _top(self.weekday_counts)
+        return calendar.day_name[i], n
+
+    def popular_hour(self):
+        """ Returns the most common start hour and its count. """
+        return _top(self.hour_counts)
+
+    # --- stations and trips
+    def popular_start_station(self):
+        """ Returns name and count of the most common start station. """
+        i, n = _top(self.start_counts)
+        return self.stations[i], n
+
+    def popular_end_station(self):
+        """ Returns name and count of the most common end station. """
+        i, n = _top(self.end_counts)
+        return self.stations[i], n
+
+    def top_destinations(self, station, k=1):
+        """ Returns the k most common (end station, count) pairs of trips starting at a station. """
+        return [(self.stations[i], n) for i, n in self.od.top_destinations(self.stations.index(station), k)]
+
+    def top_origins(self, station, k=1):
+        """ Returns the k most common (start station, count) pairs of trips ending at a station. """
+        return [(self.stations[i], n) for i, n in self.od.top_origins(self.stations.index(station), k)]
+
+    def top_destination(self, station):
+        """ Returns name and count of the most common end station of trips starting at a station. """
+        return self.top_destinations(station)[0]
+
+    def top_origin(self, station):
+        """ Returns name and count of the most common start station of trips ending at a station. """
+        return self.top_origins(station)[0]
+
+    def top_trips(self, k=1, directed=False):
+        """ Returns the k most common trips as (station A, station B, count) tuples.
+            Args:
+                (int) k - number of trips to return
+                (bool) directed - count A > B and B > A separately if True,
+                    otherwise together (round trips A > A count on their own)
+        """
+        pairs = self.od.top_trips(k) if directed else self.od.top_pairs(k)
+        return [(self.stations[a], self.stations[b], n) for a, b, n in pairs]
+
+    def popular_trip(self):
+        """ Returns the most common combination of stations regardless of direction.
+            Returns:
+                (tuple) station A, station B (equal for round trips) and the trip count
+        """
+        return self.top_trips(1)[0]
+
+    # --- trip duration
+    def duration_mean(self):
+        """ Returns the average trip duration in seconds. """
+        return self.duration_sum / self.duration_count if self.duration_count else None
+
+    # --- users
+    def birth_year_stats(self):
+        """ Returns earliest, most recent and most common year of birth (None if not available). """
+        if not self.birth_years:
+            return None
+        years = sorted(self.birth_years)
+        mode = max(years, key=lambda year: self.birth_years[year])
+        return years[0], years[-1], mode
@@ -0,0 +1,309 @@
+""" Non-interactive batch mode of the bikeshare data browser.
+
+    Computes the statistics of one or many (city, month, day) selections
+    without any input() prompts and writes them as JSON or CSV, e.g.
+
+        python bikeshare.py --city chicago washington --month all march --day all friday
+        python bikeshare.py --city all --month all --day all --format csv -o report.csv
+        python bikeshare.py --city chicago --month all --day all monday --cube
+        python bikeshare.py --city all --chunksize 500000 --top 10 --approx
+        python bikeshare.py --city chicago --month all --durations
+
+    Lists of cities/months/days are expanded into all their combinations. The
+    data is loaded once per run and every combination is filtered from the
+    loaded frame instead of being loaded again. With --cube only the count
+    based results are reported, straight from the data cube (see cube.py).
+    --top N adds the N most common start/end stations, trips and years of
+    birth, exactly or - with --approx - in bounded memory (see hitters.py).
+    --durations adds the trip duration distribution (mean, p50/p90/p99 and
+    outliers) per city, month, weekday, hour and user type (see durations.py).
+
+    From Python the same is available as run_batch():
+
+        import batch
+        results = batch.run_batch(['chicago'], ['january', 'february'], ['all'])
+"""
+import argparse
+import csv
+import itertools
+import json
+import sys
+
+import numpy as np
+
+import bikeshare
+import store
+from aggregates import BikeshareAggregates
+from durations import DurationStats
+from hitters import DIMENSIONS, HeavyHitters
+
+CITY_ALIASES = {'nyc': 'new york city', 'dc': 'washington'}
+
+
+def normalize_selection(cities, months, days):
+    """ Checks and normalizes lists of city, month and day names.
+        Args:
+            (list) cities, months, days - names as typed by a user, 'all' allowed
+        Returns:
+            three lists of lower-case names
+        Raises:
+            ValueError - for a name that is not known
+    """
+    cities = [CITY_ALIASES.get(c.strip().lower(), c.strip().lower()) for c in cities]
+    months = [m.strip().lower() for m in months]
+    days = [d.strip().lower() for d in days]
+    for name, valid in ((cities, list(bikeshare.CITY_DATA) + ['all']),
+                        (months, list(store.MONTHS) + ['all']),
+                        (days, list(store.DAYS) + ['all'])):
+        for value in name:
+            if value not in valid:
+                raise ValueError('unknown selection {!r}, expected one of: {}'.format(value, ', '.join(valid)))
+    return cities, months, days
+
+
+def report(agg):
+    """ Collects the results of all statistics menu options as a plain dictionary.
+        Args:
+            agg - BikeshareAggregates of a selection
+        Returns:
+            (dict) nested results, None where the data does not allow an answer
+    """
+    result = {'trips': agg.trips}
+    if agg.trips == 0:
+        return result
+    popular_start, start_count = agg.popular_start_station()
+    popular_end, end_count = agg.popular_end_station()
+    station_a, station_b, trip_count = agg.popular_trip()
+    yob = agg.birth_year_stats()
+    result.update({
+        'time': {
+            'popular_month': agg.popular_month()[0],
+            'popular_weekday': agg.popular_weekday()[0],
+            'popular_hour': agg.popular_hour()[0],
+        },
+        'station': {
+            'popular_start_station': popular_start,
+            'popular_start_station_count': start_count,
+            'popular_start_destination': agg.top_destination(popular_start)[0],
+            'popular_end_station': popular_end,
+            'popular_end_station_count': end_count,
+            'popular_end_origin': agg.top_origin(popular_end)[0],
+            'popular_trip': [station_a, station_b],
+            'popular_trip_count': trip_count,
+        },
+        'trip': {
+            'total_duration': agg.duration_sum,
+            'max_duration': agg.duration_max,
+            'mean_duration': agg.duration_mean(),
+        },
+        'user': {
+            'user_types': agg.user_types,
+            'genders': agg.genders,
+            'birth_year_earliest': yob[0] if yob else None,
+            'birth_year_latest': yob[1] if yob else None,
+            'birth_year_mode': yob[2] if yob else None,
+        },
+    })
+    return result
+
+
+def count_report(agg):
+    """ Collects the count based results of a selection answered by the data cube.
+        Args:
+            agg - BikeshareAggregates as returned by CountCube.aggregates
+        Returns:
+            (dict) trip, time, duration total and user type/gender results
+    """
+    result = {'trips': agg.trips}
+    if agg.trips == 0:
+        return result
+    result.update({
+        'time': {
+            'popular_month': agg.popular_month()[0],
+            'popular_weekday': agg.popular_weekday()[0],
+            'popular_hour': agg.popular_hour()[0],
+        },
+        'trip': {
+            'total_duration': agg.duration_sum,
+            'mean_duration': agg.duration_mean(),
+        },
+        'user': {
+            'user_types': agg.user_types,
+            'genders': agg.genders,
+        },
+    })
+    return result
+
+
+def top_report(hh, n):
+    """ Collects the top-N lists of all heavy hitter dimensions.
+        Args:
+            hh - HeavyHitters of a selection
+            (int) n - length of the lists
+        Returns:
+            (dict) dimension -> [name, count, error] lists, plus the error bounds
+    """
+    result = {name: [[list(key) if isinstance(key, tuple) else key, count, error]
+                     for key, count, error in hh.top(name, n)] for name in DIMENSIONS}
+    result['error_bounds'] = hh.error_bounds()
+    return result
+
+
+def _stream(city, month, day, chunksize, hh=None, durations=False):
+    """ Aggregates a selection from the csv files chunk by chunk, counting heavy hitters
+        and duration distributions on the way.
+        Returns:
+            BikeshareAggregates, DurationStats (or None)
+    """
+    agg = BikeshareAggregates()
+    stats = DurationStats() if durations else None
+    for chunk in bikeshare.load_data(city, month, day, chunksize):
+        agg = agg.merge(BikeshareAggregates.from_frame(chunk))
+        if hh is not None:
+            hh.update(chunk)
+        if durations:
+            stats = stats.merge(DurationStats.from_frame(chunk))
+    return agg, stats
+
+
+def _load_once(cities):
+    """ Loads all rows needed for a set of cities once, together with their filter codes.
+        Returns:
+            df, city labels (array or None), month codes, weekday codes
+    """
+    if len(cities) == 1 and cities[0] != 'all':
+        df = bikeshare.load_data(cities[0], 'all', 'all')
+        labels = None
+    else:
+        df = bikeshare.load_data('all', 'all', 'all')
+        labels = np.asarray(df['City'].astype(str))
+    month, weekday = store.time_codes(df['Start Time'])
+    return df, labels, month, weekday
+
+
+def run_batch(cities, months, days, processes=None, chunksize=None, use_cube=False, top=0, approximate=False,
+              durations=False):
+    """ Computes the statistics for every combination of the given cities, months and days.
+        Args:
+            (list) cities - city names or 'all'
+            (list) months - month names or 'all'
+            (list) days - weekday names or 'all'
+            (int) processes - optional: aggregate every combination in a process pool
+            (int) chunksize - optional: stream every combination from the csv files
+            (bool) use_cube - answer only the count based statistics, from the data cube
+            (int) top - optional: add the top-N stations, trips and years of birth
+            (bool) approximate - count the top-N with bounded memory (Count-Min/Space-Saving)
+            (bool) durations - optional: add the trip duration distributions per group
+        Returns:
+            (list) one dictionary per combination with the selection and its report
+    """
+    cities, months, days = normalize_selection(cities, months, days)
+    if (top or durations) and (processes or use_cube):
+        raise ValueError('top-N lists and duration distributions are not available with processes or the data cube')
+    combinations = list(itertools.product(cities, months, days))
+
+    results = []
+    if use_cube:
+        for city, month, day in combinations:
+            agg = bikeshare.count_aggregates(city, month, day)
+            if agg is None:
+                # no data cube without columnar stores - count the loaded rows instead
+                agg = BikeshareAggregates.from_frame(bikeshare.load_data(city, month, day))
+            results.append({'city': city, 'month': month, 'day': day, **count_report(agg)})
+        return results
+    if processes or chunksize:
+        # out-of-core modes: nothing is kept in memory between combinations
+        for city, month, day in combinations:
+            if processes:
+                agg = bikeshare.aggregate_data(city, month, day, processes)
+                results.append({'city': city, 'month': month, 'day': day, **report(agg)})
+                continue
+            hh = HeavyHitters(approximate) if top else None
+            agg, stats = _stream(city, month, day, chunksize, hh, durations)
+            results.append({'city': city, 'month': month, 'day': day, **report(agg)})
+            if top:
+                results[-1]['top'] = top_report(hh, top)
+            if durations:
+                results[-1]['durations'] = stats.to_dict()
+        return results
+
+    df, labels, month_no, weekday_no = _load_once(sorted(set(cities)))
+    for city, month, day in combinations:
+        mask = np.ones(len(df), dtype=bool)
+        if labels is not None and city != 'all':
+            mask &= labels == city.title()
+        if month != 'all':
+            mask &= month_no == store.month_code(month)
+        if day != 'all':
+            mask &= weekday_no == store.day_code(day)
+        agg = BikeshareAggregates.from_frame(df[mask])
+        results.append({'city': city, 'month': month, 'day': day, **report(agg)})
+        if top:
+            results[-1]['top'] = top_report(HeavyHitters.from_frame(df[mask], approximate), top)
+        if durations:
+            results[-1]['durations'] = DurationStats.from_frame(df[mask]).to_dict()
+    return results
+
+
+def _flatten(result, prefix=''):
+    """ Flattens a nested report into 'section.key' columns for the csv output. """
+    row = {}
+    for key, value in result.items():
+        if isinstance(value, dict) and key not in ('user_types', 'genders'):
+            row.update(_flatten(value, prefix + key + '.'))
+        elif isinstance(value, (dict, list)):
+            row[prefix + key] = json.dumps(value)
+        else:
+            row[prefix + key] = value
+    return row
+
+
+def write_results(results, out, fmt='json'):
+    """ Writes batch results to an open text file as JSON or CSV. """
+    if fmt == 'json':
+        json.dump(results, out, indent=2)
+        out.write('\n')
+        return
+    rows = [_flatten(result) for result in results]
+    fields = []
+    for row in rows:
+        fields += [key for key in row if key not in fields]
+    writer = csv.DictWriter(out, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def _split(values):
+    """ Accepts both '--month january february' and '--month january,february'. """
+    return [item for value in values for item in value.split(',') if item.strip()]
+
+
+def main(argv=None):
+    """ Command line entry point, see the module docstring for examples. """
+    parser = argparse.ArgumentParser(prog='bikeshare.py', description='Compute US bikeshare statistics without interaction.')
+    parser.add_argument('--city', nargs='+', default=['all'], help="chicago, 'new york city' (nyc), washington (dc) or all")
+    parser.add_argument('--month', nargs='+', default=['all'], help='month name(s) or all')
+    parser.add_argument('--day', nargs='+', default=['all'], help='weekday name(s) or all')
+    parser.add_argument('--format', choices=('json', 'csv'), default='json', help='output format (default: json)')
+    parser.add_argument('-o', '--output', help='write to this file instead of stdout')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--processes', type=int, help='aggregate in a pool of that many worker processes')
+    mode.add_argument('--chunksize', type=int, help='stream the csv files in chunks of that many rows')
+    mode.add_argument('--cube', action='store_true', help='report the count based statistics from the data cube only')
+    parser.add_argument('--top', type=int, default=0, help='add the N most common stations, trips and years of birth')
+    parser.add_argument('--approx', action='store_true', help='count the --top lists approximately in bounded memory')
+    parser.add_argument('--durations', action='store_true', help='add trip duration percentiles per city, month, weekday, hour and user type')
+    args = parser.parse_args(argv)
+
+    try:
+        results = run_batch(_split(args.city), _split(args.month), _split(args.day),
+                            processes=args.processes, chunksize=args.chunksize, use_cube=args.cube,
+                            top=args.top, approximate=args.approx, durations=args.durations)
+    except ValueError as err:
+        parser.error(str(err))
+    if args.output:
+        with open(args.output, 'w', newline='') as out:
+            write_results(results, out, args.format)
+    else:
+        write_results(results, sys.stdout, args.format)
+    return 0
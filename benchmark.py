@@ -0,0 +1,255 @@
+""" Benchmark suite for the bikeshare data browser.
+
+    Generates deterministic synthetic data in the shape of the CITY_DATA csv
+    files (Washington without 'Gender'/'Birth Year' and with fractional trip
+    durations, like the real exports) and times every stage behind the menu:
+    csv conversion, cached loads per filter combination, the aggregates behind
+    time_stats/station_stats/trip_duration_stats/user_stats, the count cube,
+    raw data paging, streaming and (optionally) the process pool. For every
+    stage the wall time and the peak of traced memory are recorded - in two
+    separate runs, since tracing allocations slows them down several times.
+
+        python benchmark.py --rows 100000
+        python benchmark.py --rows 10000000 --dir /data/bench --sweep -o bench.json
+
+    --rows is the number of trips per city; files are only generated if they
+    are missing, so repeated runs on the same --dir compare like with like.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import bikeshare
+import cube
+import paging
+import querycache
+import store
+from aggregates import BikeshareAggregates
+
+# city -> (file name, number of stations, has user data, fractional durations)
+SYNTHETIC_CITIES = {'chicago': ('chicago.csv', 580, True, False),
+                    'new york city': ('new_york_city.csv', 800, True, False),
+                    'washington': ('washington.csv', 480, False, True)}
+# share of the rows per user type (missing values included, like the real data)
+USER_TYPES = (('Subscriber', 0.80), ('Customer', 0.19), ('Dependent', 0.005), (None, 0.005))
+GENDERS = (('Male', 0.70), ('Female', 0.22), (None, 0.08))
+WRITE_CHUNK = 1000000
+
+
+def _choice(rng, options, n):
+    """ Draws n values from (value, probability) pairs. """
+    values = np.array([value for value, _ in options], dtype=object)
+    return values[rng.choice(len(options), size=n, p=[p for _, p in options])]
+
+
+def generate_city(path, rows, n_stations, with_user_data=True, fractional=False, seed=0):
+    """ Writes a synthetic city csv file, chunk by chunk so any size fits in memory.
+        Start times are spread over January to June 2017 with a daily pattern,
+        station popularity follows a Zipf-like distribution.
+        Args:
+            (str) path - csv file to write
+            (int) rows - number of trips
+            (int) n_stations - number of distinct stations
+            (bool) with_user_data - write 'Gender' and 'Birth Year' columns
+            (bool) fractional - write trip durations with milliseconds
+            (int) seed - seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    stations = np.array(['{} St & Station Ave #{}'.format(i * 7 % 97, i) for i in range(n_stations)], dtype=object)
+    popularity = 1.0 / np.arange(1, n_stations + 1) ** 0.8
+    popularity /= popularity.sum()
+    hour_weights = np.array([1, 1, 1, 1, 1, 2, 4, 8, 10, 7, 5, 5, 6, 6, 6, 7, 9, 11, 9, 6, 4, 3, 2, 1], dtype=float)
+    hour_weights /= hour_weights.sum()
+    first_day = np.datetime64('2017-01-01T00:00:00', 's')
+
+    written = 0
+    with open(path, 'w', newline='') as f:
+        while written < rows:
+            n = min(WRITE_CHUNK, rows - written)
+            seconds = (rng.integers(0, 181, n) * 86400 + rng.choice(24, size=n, p=hour_weights) * 3600
+                       + rng.integers(0, 3600, n))
+            start = first_day + seconds.astype('timedelta64[s]')
+            duration = np.round(rng.lognormal(6.5, 0.8, n), 3 if fractional else 0)
+            end = start + np.ceil(duration).astype('timedelta64[s]')
+            data = {'Start Time': np.datetime_as_string(start).astype(object),
+                    'End Time': np.datetime_as_string(end).astype(object),
+                    'Trip Duration': duration if fractional else duration.astype(np.int64),
+                    'Start Station': stations[rng.choice(n_stations, size=n, p=popularity)],
+                    'End Station': stations[rng.choice(n_stations, size=n, p=popularity)],
+                    'User Type': _choice(rng, USER_TYPES, n)}
+            if with_user_data:
+                data['Gender'] = _choice(rng, GENDERS, n)
+                years = rng.normal(1981, 11, n).round().clip(1900, 2002)
+                years[rng.random(n) < 0.1] = np.nan
+                data['Birth Year'] = years
+            df = pd.DataFrame(data, index=pd.RangeIndex(written, written + n))
+            # the csv exports store timestamps with a space between date and time
+            for col in ('Start Time', 'End Time'):
+                df[col] = df[col].str.replace('T', ' ', regex=False)
+            df.to_csv(f, header=written == 0)
+            written += n
+
+
+def generate_dataset(directory, rows, seed=0):
+    """ Generates all synthetic city files in a directory (existing files are kept).
+        Returns:
+            (dict) city name -> csv path, in the form of CITY_DATA
+    """
+    os.makedirs(directory, exist_ok=True)
+    sources = {}
+    for i, (city, (file, n_stations, with_user_data, fractional)) in enumerate(SYNTHETIC_CITIES.items()):
+        path = os.path.join(directory, file)
+        if not os.path.exists(path):
+            generate_city(path, rows, n_stations, with_user_data, fractional, seed + i)
+        sources[city] = path
+    return sources
+
+
+class Recorder:
+    """ Collects timing and peak memory of named benchmark stages. """
+
+    def __init__(self):
+        self.results = []
+
+    def stage(self, name, func, memory=True, **labels):
+        """ Runs a stage twice: timed without tracing, then under tracemalloc for its peak memory.
+            Args:
+                (str) name - stage name
+                (callable) func - runs the stage, called without arguments
+                (bool) memory - False for stages that cannot be repeated (no peak memory then)
+                labels - further fields of the result, e.g. the selection
+            Returns:
+                the return value of the timed run
+        """
+        start = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - start
+        peak_mb = None
+        if memory:
+            tracemalloc.start()
+            try:
+                func()
+                peak_mb = tracemalloc.get_traced_memory()[1] / 1024**2
+            finally:
+                tracemalloc.stop()
+        self.results.append({'stage': name, **labels, 'seconds': round(seconds, 6),
+                             'peak_mb': None if peak_mb is None else round(peak_mb, 3)})
+        print('{:<28} {:<40} {:>10.4f} s {:>10} MB'.format(
+            name, ' '.join(str(v) for v in labels.values()), seconds,
+            '-' if peak_mb is None else '{:.1f}'.format(peak_mb)), file=sys.stderr)
+        return value
+
+
+def filter_combinations(sweep=False):
+    """ Returns the (city, month, day) selections to benchmark.
+        Args:
+            (bool) sweep - every combination instead of a representative set
+    """
+    cities = list(bikeshare.CITY_DATA) + ['all']
+    if sweep:
+        months = ['all'] + list(store.MONTHS[:6])
+        days = ['all'] + list(store.DAYS)
+    else:
+        months, days = ['all', 'march'], ['all', 'friday']
+    return [(c, m, d) for c in cities for m in months for d in days]
+
+
+def run_benchmark(directory, rows, sweep=False, processes=None, chunksize=None, pages=1000):
+    """ Runs all benchmark stages on synthetic data.
+        Args:
+            (str) directory - where the synthetic csv files and their cache live
+            (int) rows - number of trips per city
+            (bool) sweep - benchmark every filter combination
+            (int) processes - also benchmark the process pool with that many workers
+            (int) chunksize - also benchmark streaming with that chunk size
+            (int) pages - number of raw data pages to render per paging run
+        Returns:
+            (list) one result dictionary per stage
+    """
+    recorder = Recorder()
+    # a second run would find the files already generated
+    sources = recorder.stage('generate', lambda: generate_dataset(directory, rows), memory=False, rows=rows)
+    # point the browser at the synthetic files and a cache next to them
+    bikeshare.CITY_DATA = sources
+    store.CACHE_DIR = os.path.join(directory, '.bikeshare_cache')
+    # every load is measured cold: no cached selections, in memory or on disk
+    bikeshare.QUERY_CACHE = querycache.QueryCache(max_bytes=0)
+
+    for city, path in sources.items():
+        recorder.stage('convert', lambda: store.build_store(path), city=city)
+    labels = {city.title(): path for city, path in sources.items()}
+    recorder.stage('cube build', lambda: cube.CountCube.build(labels).save())
+
+    def stats_queries(agg):
+        agg.popular_month(), agg.popular_weekday(), agg.popular_hour()
+        agg.top_destination(agg.popular_start_station()[0]), agg.top_origin(agg.popular_end_station()[0])
+        agg.popular_trip(), agg.duration_mean(), agg.birth_year_stats()
+
+    for city, month, day in filter_combinations(sweep):
+        selection = {'city': city, 'month': month, 'day': day}
+        df = recorder.stage('load_data', lambda: bikeshare.load_data(city, month, day), **selection)
+        agg = recorder.stage('aggregates', lambda: BikeshareAggregates.from_frame(df), **selection)
+        if agg.trips:
+            recorder.stage('stats queries', lambda: stats_queries(agg), **selection)
+        recorder.stage('cube query', lambda: bikeshare.count_aggregates(city, month, day), **selection)
+        if chunksize:
+            recorder.stage('streaming', lambda: BikeshareAggregates.from_chunks(
+                bikeshare.load_data(city, month, day, chunksize)), chunksize=chunksize, **selection)
+        if processes:
+            recorder.stage('parallel', lambda: bikeshare.aggregate_data(city, month, day, processes),
+                           processes=processes, **selection)
+
+    df = bikeshare.load_data('all', 'all', 'all')
+    cursor = paging.TableCursor(df)
+
+    def page_through():
+        cursor.jump(0)
+        for _ in range(pages):
+            cursor.render(cursor.page())
+
+    def jump_around():
+        for row in np.linspace(0, len(df) - 1, pages).astype(np.int64):
+            cursor.jump(row)
+            cursor.render(cursor.page())
+
+    def search():
+        cursor.find_next(cursor.station_rows(str(df['Start Station'].iloc[0])))
+        cursor.find_next(cursor.time_rows('2017-03-01 08:00'))
+
+    recorder.stage('raw_data paging', page_through, pages=pages)
+    recorder.stage('raw_data jump', jump_around, pages=pages)
+    recorder.stage('raw_data search', search)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is reported in kilobytes on Linux
+    recorder.results.append({'stage': 'process', 'max_rss_mb': round(usage.ru_maxrss / 1024, 1)})
+    return recorder.results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the bikeshare data browser on synthetic data.')
+    parser.add_argument('--rows', type=int, default=100000, help='trips per city (default: 100000)')
+    parser.add_argument('--dir', default='bench_data', help='directory for the synthetic files (default: bench_data)')
+    parser.add_argument('--sweep', action='store_true', help='benchmark every city/month/day combination')
+    parser.add_argument('--processes', type=int, help='also benchmark the process pool')
+    parser.add_argument('--chunksize', type=int, help='also benchmark streaming with this chunk size')
+    parser.add_argument('--pages', type=int, default=1000, help='raw data pages to render (default: 1000)')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.dir, args.rows, args.sweep, args.processes, args.chunksize, args.pages)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
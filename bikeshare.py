@@ -1,11 +1,25 @@
-import time
-import pandas as pd
-import numpy as np
+import os
+import sys
+
+import instrument
+import store
+import ingest
+from aggregates import BikeshareAggregates
+import parallel
+import cube
+import paging
+import querycache
+from durations import DurationStats, format_durations
 
 CITY_DATA = { 'chicago': 'chicago.csv',
               'new york city': 'new_york_city.csv',
               'washington': 'washington.csv' }
 
+# number of worker processes for the statistics (0 = compute in this process)
+PROCESSES = int(os.environ.get('BIKESHARE_PROCESSES', 0))
+# filtered rows and statistics of earlier selections, see querycache.py
+QUERY_CACHE = querycache.QueryCache.from_env()
+
 
 def get_filters():
     """ Asks user to specify a city, month, and day to analyze.
@@ -43,49 +57,108 @@ def get_filters():
     return city.strip().lower(), month.strip().lower(), day.strip().lower()
 
 
-def load_data(city, month, day):
+def city_sources(city):
+    """ Returns the data files of a city (or of all cities) including files added with ingest.py.
+        Args:
+            (str) city - name of the city, or "all"
+        Returns:
+            (dict) city label (e.g. 'Chicago') -> csv path or list of file segments
+    """
+    return ingest.city_sources(CITY_DATA, None if city == 'all' else [city])
+
+def selection_key(city, month, day):
+    """ Returns the key of a selection in QUERY_CACHE (changes whenever its data files change). """
+    return querycache.selection_key(city, month, day, city_sources(city))
+
+@instrument.instrumented('load')
+def load_data(city, month, day, chunksize=None):
     """ Loads data for the specified city and filters by month and day if applicable.
         Args:
             (str) city - name of the city to analyze
             (str) month - name of the month to filter by, or "all" to apply no month filter
             (str) day - name of the day of week to filter by, or "all" to apply no day filter
+            (int) chunksize - optional: stream the csv files in chunks of that many rows
+                (for files larger than memory) instead of loading them at once
         Returns:
-            df - Pandas DataFrame containing city data filtered by month and day
+            df - Pandas DataFrame containing city data filtered by month and day,
+                 or a generator of such DataFrames if chunksize is given
     """
 
-    # load data file into a dataframe
-    if city != 'all':
-        df = pd.read_csv(CITY_DATA[city])
-    else:
-        df = pd.DataFrame()
-        for city_name in CITY_DATA:
-            #df = df.append(pd.read_csv(CITY_DATA[city]))
-            df_new = pd.read_csv(CITY_DATA[city_name])
-            df_new.insert(0,'City',city_name.title())
-            df = df.append(df_new)
-    # Convert the Start Time column to datetime
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
-    # Extract month and day of week from Start Time to create new columns
-    # filter by month if applicable
-    if month != 'all':
-        df['Start Time'] = pd.to_datetime(df['Start Time'])
-        df['Month'] = df['Start Time'].dt.month_name()
-        df = df[df['Month'] == month.title()]
-
-    # filter by day of week if applicable
-    if day != 'all':
-        df['Start Time'] = pd.to_datetime(df['Start Time'])
-        df['Weekday'] = df['Start Time'].dt.day_name()
-        df = df[df['Weekday'] == day.title()]
-
-    for extra_col in ['Weekday','Month']:
-        try:
-            df.drop([extra_col], axis = 1, inplace = True)
-        except KeyError:
-            print('')
-            #print('Column {} not created...'.format(extra_col))
+    # month/weekday filters are passed on as integer codes and resolved by the
+    # time index of the columnar store, so only matching rows are loaded
+    month_no = store.month_code(month)
+    day_no = store.day_code(day)
+
+    # the file of every city plus the files added to it later (see ingest.py)
+    sources = city_sources(city)
+
+    # streaming mode: filtered chunks straight from the csv files, to be
+    # aggregated with BikeshareAggregates.from_chunks
+    if chunksize:
+        if city != 'all':
+            return store.iter_city_chunks(sources[city.title()], month_no, day_no, chunksize)
+        return store.iter_cities_chunks(sources, month_no, day_no, chunksize)
+
+    # load data file into a dataframe (through the columnar cache, see store.py);
+    # the row positions of a selection are cached, a repeated selection skips the filters
+    key = querycache.selection_key(city, month, day, sources)
+    cached = QUERY_CACHE.get(key, 'rows')
+    parts = store.select_parts(sources, month_no, day_no, rows=cached)
+    if parts is None:
+        # no columnar cache available - parse the csv files
+        if city != 'all':
+            return store.read_city(sources[city.title()], month_no, day_no)
+        return store.read_cities(sources, month_no, day_no)
+    if cached is None:
+        QUERY_CACHE.put(key, 'rows', [rows for _, _, rows in parts])
+
+    # a single city, or all three cities read concurrently and assembled once
+    return store.frame_from_parts(parts, 'City' if city == 'all' else None)
+
+def aggregate_data(city, month, day, processes=None):
+    """ Computes the statistics of a selection in a process pool: every city file
+        (large files in several partitions) is loaded and aggregated by its own
+        worker, the partial results are merged.
+        Args:
+            (str) city - name of the city to analyze, or "all"
+            (str) month - name of the month to filter by, or "all" to apply no month filter
+            (str) day - name of the day of week to filter by, or "all" to apply no day filter
+            (int) processes - number of worker processes (default: number of CPUs)
+        Returns:
+            BikeshareAggregates of the selection
+    """
+    return parallel.parallel_aggregates(city_sources(city), store.month_code(month), store.day_code(day), processes)
 
-    return df
+def count_aggregates(city, month, day):
+    """ Answers the count based statistics of a selection from the data cube (see cube.py)
+        instead of the loaded rows.
+        Args:
+            (str) city - name of the city to analyze, or "all"
+            (str) month - name of the month to filter by, or "all" to apply no month filter
+            (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        Returns:
+            BikeshareAggregates with trip, time, user type/gender and duration total counts,
+            None if the cube cannot be built (no columnar stores, e.g. the cache directory is not writable)
+    """
+    city_label = None if city == 'all' else city.title()
+    try:
+        count_cube = cube.get_cube(city_sources('all'))
+    except OSError:
+        return None
+    return count_cube.aggregates(city_label, store.month_code(month), store.day_code(day))
+
+def total_aggregates(city):
+    """ Returns the statistics of all trips of a city (or of all cities) from the
+        persisted per-city totals, which ingest.py keeps up to date.
+        Args:
+            (str) city - name of the city to analyze, or "all"
+        Returns:
+            BikeshareAggregates of the unfiltered data
+    """
+    agg = BikeshareAggregates()
+    for label, source in city_sources(city).items():
+        agg = agg.merge(ingest.city_totals(label, source))
+    return agg
 
 def data_summary(df):
     """Displays a short summary of the selected data/filtered dataframe.
@@ -96,13 +169,17 @@ def data_summary(df):
     print('-'*60)
     msg = '\nAccording to your selection, the dataset has {} rows and contains the following {} columns:\n{}\n'
     print(msg.format(int(df.size/len(df.columns)), int(len(df.columns)),' '+"\n ".join(df.columns)))
-    print("Here is a preview of the data table:\n", df,'\nYou can select raw data access from the main menu to go row-wise through the entire table.')
+    compact, plain = store.memory_footprint(df)
+    print('In memory the table takes {:.1f} MB (a plain csv import would take about {:.1f} MB).\n'.format(compact/1024**2, plain/1024**2))
+    print("Here is a preview of the data table:\n", paging.TableCursor(df).overview(),'\nYou can select raw data access from the main menu to go row-wise through the entire table.')
     input('[ENTER] to return to the selection menu.  ')
 
 ##
 def raw_data(df):
     """ Displays raw data table (unaltered imported data table after filtering).
-        Allows to scroll down by 5 new lines each or by a selected number of rows.
+        Allows to scroll down by 5 new lines each or by a selected number of rows,
+        to jump to a row and to search for a station or a start time.
+        Only the visible rows are formatted, see paging.TableCursor.
         Argument: df - Pandas DataFrame containing filtered or unfiltered city data
     """
 
@@ -110,144 +187,112 @@ def raw_data(df):
     print('\nThis section will allow you to access the raw data table that is currently loaded.\n')
     print('\nYou will be able to go through the table by entering either the number of rows you would like to see next, [y]es for the default option (5 rows) or [n]o to abort.\n')
     print('\nPlease bear in mind that bigger numbers of rows may not be fully displayed on your screen, however, you will be able to skip/scroll through the table faster.')
+    print('\nBy typing [row <number>] you jump to that row, [station <name>] shows the next trip from or to that station and [time <yyyy-mm-dd hh:mm>] the next trip started within that hour.')
     print('\nBy typing [df] you can select to show the condensed overview of the entire raw data table and return to the main menu.')
     print('\nThe currently selected data table has {} rows.'.format(len(df)))
     print('Here are the first 5 rows of that raw data table:')
-    r_list = [0,1,2,3,4]
-    limit = len(df) -1
+    cursor = paging.TableCursor(df)
+    rows = cursor.page()
     while True:
         print('-'*140)
-        print(df.iloc[r_list])
+        print(cursor.render(rows))
         print('-'*140)
-        #print('Please enter the number of rows [1...1,000,000] you would like to see next, [y]es for the |default| option (5 rows) or [n]o to abort.')
+        if cursor.at_end:
+            print('That displayed the last rows of the table!')
+            break
         print('Would you like to proceed?')
         print('Please enter the number of rows you would like to see next, [yes] for the |default| option (5 rows) or [no] to abort.')
         while True:
+            x = input('').strip()
+            command, _, arg = x.partition(' ')
+            command = command.lower()
             try:
-                x = str(input(''))
-                if not (x in ('yes','no','df') or (int(x) > 0)): #(0 < int(x) <= 1000000)):
-                    raise ValueError
-            except (ValueError, IndexError):
-                print("Invalid entry - Please enter a valid positive number, 'yes' or 'no' and hit [ENTER/RETURN].")
-            else:
-                if x.strip().lower() == 'no':
+                if command in ('yes', 'no', 'df'):
                     break
-                if x == 'df':
-                    print(df)
-                    x = 'no'
+                elif command == 'row':
+                    # rows are counted from 0 like the table index
+                    cursor.jump(int(arg))
                     break
-                else:
-                    if x == 'yes':
-                         x = 5
-                    if r_list[-1] >= (limit-int(x)): #if row number selection exceeds remaining rows
-                        if int(x) > limit - r_list[-1]:
-                            x = limit - r_list[-1]   # restrict selection to
-                        n_list = list(range(int(x))) # number of remaining rows
-                        r_list = [y + (limit - n_list[-1]) for y in n_list]
-                        # show no of remaining rows from last row position to the last row of the table
-                        print(df.iloc[r_list])
-                        print('That displayed the last rows of the table!')
-                        x = 'no'
-                        break
-                    else:
-                        n_list = list(range(int(x)))
-                        r_list = [y + r_list[-1]+1 for y in n_list]
-                        break
-        if x == 'no':
+                elif command in ('station', 'time'):
+                    found = cursor.station_rows(arg.strip()) if command == 'station' else cursor.time_rows(arg)
+                    if cursor.find_next(found) is None:
+                        print('No matching trips - please try again.')
+                        continue
+                    print('{} matching trips, showing the next one:'.format(len(found)))
+                    break
+                elif int(x) > 0:
+                    break
+                raise ValueError
+            except ValueError:
+                print("Invalid entry - Please enter a valid positive number, 'yes' or 'no' and hit [ENTER/RETURN].")
+        if command == 'no':
+            break
+        if command == 'df':
+            print(cursor.overview())
             break
+        rows = cursor.page(int(x) if x.isdigit() else None)
     print('-'*60)
     input('[ENTER] to return to the selection menu.  ')
 
 
-def time_stats(df):
+def time_stats(agg):
     """ Displays statistics on the most frequent times of travel.
-        Argument: df - Pandas DataFrame containing filtered or unfiltered dataset
+        Argument: agg - BikeshareAggregates of the filtered or unfiltered dataset
     """
 
     print('-'*60)
     print('\nCalculating The Most Frequent Times of Travel...\n')
-    start_time = time.time()
-
-    #ensure datetime format
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
-
-    # display the most common month
-    df['Month'] = df['Start Time'].dt.month_name()
-    count_table = df.groupby(['Month'])['Month'].count()
-    popular_month = count_table[count_table == count_table.max()].index[0]
-    print('\nThe most popular month is {}.\n'.format(popular_month))
-
-    # display the most common day of week
-    df['Weekday'] = df['Start Time'].dt.day_name()
-    count_table = df.groupby(['Weekday'])['Weekday'].count()
-    popular_dow = count_table[count_table == count_table.max()].index[0]
-    print('\nThe most popular day of the week is {}.\n'.format(popular_dow))
-
-    # display the most common start hour
-    df['Hour'] = df['Start Time'].dt.hour
-    count_table = df.groupby(['Hour'])['Hour'].count()
-    popular_hour = count_table[count_table == count_table.max()].index[0]
-    print('\nThe most popular hour of the day to start bike travel is {}.\n'.format(popular_hour))
-
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    with instrument.stage('time_stats') as timing:
+        # display the most common month
+        popular_month, _ = agg.popular_month()
+        print('\nThe most popular month is {}.\n'.format(popular_month))
+
+        # display the most common day of week
+        popular_dow, _ = agg.popular_weekday()
+        print('\nThe most popular day of the week is {}.\n'.format(popular_dow))
+
+        # display the most common start hour
+        popular_hour, _ = agg.popular_hour()
+        print('\nThe most popular hour of the day to start bike travel is {}.\n'.format(popular_hour))
+
+    print("\nThis took %s seconds." % timing.seconds)
     print('-'*60)
     input('[ENTER] to return to the selection menu.')
 
 
-def station_stats(df):
+def station_stats(agg):
     """ Displays statistics on the most popular stations and trip.
-        Argument: df - Pandas DataFrame containing filtered or unfiltered dataset
+        Argument: agg - BikeshareAggregates of the filtered or unfiltered dataset
     """
 
     print('-'*60)
     print('\nCalculating The Most Popular Stations and Trip...\n')
-    start_time = time.time()
-
-    # Identify the most commonly used start station
-    count_table = df.groupby(['Start Station'])['Start Station'].count()
-    popular_start = count_table[count_table == count_table.max()].index[0]
-    start_counts = count_table.max()
-    # ... and the most common destination of trips starting from it
-    #  >> cave: variable count_table is being reused <<
-    count_table = df[df['Start Station'] == popular_start].groupby(['End Station'])['Start Time'].count()
-    pop_start_destination = count_table[count_table == count_table.max()].index[0]
-    start_desti_counts = count_table.max()
-    # Print the results rgd the most common Start Station
-    print("\nThe most popular station to start bike trips is '{}' ({} counts).".format(popular_start,start_counts))
-    print("The most common destination to go from there is {} ({} counts).\n".format(pop_start_destination,start_desti_counts))
-
-    # Identify the most commonly used end station
-    count_table = df.groupby(['End Station'])['End Station'].count()
-    popular_end = count_table[count_table == count_table.max()].index[0]
-    end_counts = count_table.max()
-    # ... and the most common start/origin of trips ending there
-    count_table = df[df['End Station'] == popular_end].groupby(['Start Station'])['Start Time'].count()
-    pop_desti_origin = count_table[count_table == count_table.max()].index[0]
-    end_start_counts = count_table.max()
-    # Print the results rgd the most common End Station
-    print("\nThe most popular destination for bike trips is the station '{}' ({} counts).".format(popular_end, end_counts))
-    print("Most trips that ended there started at station {} ({} counts)\n".format(pop_desti_origin,end_start_counts))
-
-    # Display most frequent combination [bidirectional]
-    # Identify return trips and round trips
-    count_table1 = df[df['Start Station']!=df['End Station']].groupby(['Start Station', 'End Station'])['Start Time'].count()   # direction A > B
-    count_table2 = df[df['Start Station']!=df['End Station']].groupby(['End Station', 'Start Station'])['Start Time'].count() # direction B > A
-    count_table3 = df[df['Start Station']==df['End Station']].groupby(['End Station', 'Start Station'])['Start Time'].count() # round trips
-
-    df_join = pd.DataFrame({'Start>End': count_table1 , 'End>Start':count_table2, 'Round': count_table3})
-
-    df_join.fillna(0, inplace=True)
-    df_join['sum'] = df_join['Start>End'] + df_join['End>Start'] + df_join['Round']
-    df_join.sort_values(by = ['sum'], ascending = False)
-    ## This approach will allow to identify the most popular combination of stations but it will leave double row entries, one for the directional label A > B and another for B > A "return" trips.
-
-    popular_combo = df_join[df_join['sum'] == df_join['sum'].max()].index[0]
-    if popular_combo[0] != popular_combo[1]:
-        print("\nWith {} counts, the most popular bike trips were between the stations '{}' and '{}'.\n".format(int(df_join['sum'].max()),popular_combo[0], popular_combo[1]))
-    else:
-        print("\nThe most popular trips were round trips starting from and ending at station '{}' ({} counts).\n".format(popular_combo[0], int(df_join['sum'].max())))
+    with instrument.stage('station_stats') as timing:
+        # Identify the most commonly used start station
+        popular_start, start_counts = agg.popular_start_station()
+        # ... and the most common destination of trips starting from it
+        pop_start_destination, start_desti_counts = agg.top_destination(popular_start)
+        # Print the results rgd the most common Start Station
+        print("\nThe most popular station to start bike trips is '{}' ({} counts).".format(popular_start,start_counts))
+        print("The most common destination to go from there is {} ({} counts).\n".format(pop_start_destination,start_desti_counts))
+
+        # Identify the most commonly used end station
+        popular_end, end_counts = agg.popular_end_station()
+        # ... and the most common start/origin of trips ending there
+        pop_desti_origin, end_start_counts = agg.top_origin(popular_end)
+        # Print the results rgd the most common End Station
+        print("\nThe most popular destination for bike trips is the station '{}' ({} counts).".format(popular_end, end_counts))
+        print("Most trips that ended there started at station {} ({} counts)\n".format(pop_desti_origin,end_start_counts))
+
+        # Display most frequent combination [bidirectional]: trips A > B and B > A
+        # are counted together, round trips A > A on their own
+        station_a, station_b, combo_counts = agg.popular_trip()
+        if station_a != station_b:
+            print("\nWith {} counts, the most popular bike trips were between the stations '{}' and '{}'.\n".format(combo_counts, station_a, station_b))
+        else:
+            print("\nThe most popular trips were round trips starting from and ending at station '{}' ({} counts).\n".format(station_a, combo_counts))
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    print("\nThis took %s seconds." % timing.seconds)
     print('-'*60)
     input('[ENTER] to return to the selection menu.  ')
 
@@ -270,76 +315,84 @@ def ret_time(total, unit = 'hrs'):
 
     return msg
 
-def trip_duration_stats(df):
+def trip_duration_stats(agg, durations=None):
     """ Displays statistics on the total and average trip duration.
-        Argument: df - Pandas DataFrame containing filtered or unfiltered dataset
+        Arguments: agg - BikeshareAggregates of the filtered or unfiltered dataset
+                   durations - optional DurationStats of the same data for the distribution
     """
 
     print('-'*60)
     print('\nCalculating Trip Duration...\n')
-    start_time = time.time()
-
-    # display total travel time
-    total = df['Trip Duration'].sum()
-    print('\nThe accumulated travel duration of all users in the selected period is {}.\n'.format(ret_time(total)))
-
-    # display longest travel time
-    longest = df['Trip Duration'].max()
-    print('\nThe longest travel duration of bike trips in the selected period is {}.\n'.format(ret_time(longest)))
-
-
-    # display mean travel time
-    mean_dur = df['Trip Duration'].mean()
-    print('\nThe average travel duration of bike trips is {}.\n'.format(ret_time(mean_dur, unit = 'min')))
-
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    with instrument.stage('trip_duration_stats') as timing:
+        # display total travel time
+        total = agg.duration_sum
+        print('\nThe accumulated travel duration of all users in the selected period is {}.\n'.format(ret_time(total)))
+
+        # display longest travel time
+        longest = agg.duration_max
+        print('\nThe longest travel duration of bike trips in the selected period is {}.\n'.format(ret_time(longest)))
+
+
+        # display mean travel time
+        mean_dur = agg.duration_mean()
+        print('\nThe average travel duration of bike trips is {}.\n'.format(ret_time(mean_dur, unit = 'min')))
+
+        # display the distribution of travel times, overall and per user type
+        if durations is not None:
+            overall = durations.table('all').iloc[0]
+            print('\nHalf of the trips take less than {}, 90% less than {} and 99% less than {}.'.format(
+                ret_time(overall['p50'], unit = 'min'), ret_time(overall['p90'], unit = 'min'), ret_time(overall['p99'], unit = 'min')))
+            print('{} trips are unusually short or long (outside 1.5 interquartile ranges).\n'.format(int(overall['outliers'])))
+            by_type = durations.table('user_type')
+            by_type = by_type[by_type['trips'] > 0]
+            for column in ['mean', 'p50', 'p90', 'p99']:
+                by_type[column] = format_durations(by_type[column])
+            print('Trip durations (h:mm:ss) per user type:\n', by_type.to_string(), '\n')
+
+    print("\nThis took %s seconds." % timing.seconds)
     print('-'*60)
     input('[ENTER] to return to the selection menu.')
 
 
-def user_stats(df):
+def user_stats(agg):
     """ Displays statistics on bikeshare users.
-        Argument: df - Pandas DataFrame containing filtered or unfiltered dataset
+        Argument: agg - BikeshareAggregates of the filtered or unfiltered dataset
     """
 
     print('-'*60)
     print('\nCalculating User Stats...\n')
-    start_time = time.time()
-
-    # Display counts of user types
-    ut_counts =  df[['Start Time','User Type']].dropna(axis=0).groupby(['User Type'])['Start Time'].count()
-    if ut_counts.max() != 0:
-        print('\nThe following number of bike trips were registered:')
-        for count in ut_counts:
-            print('   {} trips by {}s '.format(count,ut_counts[ut_counts == count].index[0], count))
+    with instrument.stage('user_stats') as timing:
+        # Display counts of user types
+        if agg.user_types:
+            print('\nThe following number of bike trips were registered:')
+            for user_type, count in agg.user_types.items():
+                print('   {} trips by {}s '.format(count, user_type))
 
 
-    # Display counts of gender categories
-    try:
-        gt_counts =  df[['Start Time','Gender']].dropna(axis=0).groupby(['Gender'])['Start Time'].count()
-        if gt_counts.max() != 0:
+        # Display counts of gender categories
+        if agg.genders:
             print('\nGrouping by gender categories, the following number of bike trips were registered:')
-            for count in gt_counts:
-                print('   {} trips by {}s '.format(count,gt_counts[gt_counts == count].index[0], count))
-    except:
-        print('No data for gender categories are available in this data set.')
+            for gender, count in agg.genders.items():
+                print('   {} trips by {}s '.format(count, gender))
+        else:
+            print('No data for gender categories are available in this data set.')
 
 
-    # Display earliest, most recent, and most common year of birth (yob)
-    try:
-        mode_yob = df[['Start Time','Birth Year']].dropna(axis=0)['Birth Year'].mode()[0]
-        ear_yob = df[['Start Time','Birth Year']].dropna(axis=0)['Birth Year'].min()
-        lat_yob = df[['Start Time','Birth Year']].dropna(axis=0)['Birth Year'].max()
-        print('\nThe oldest customer at the time was born in the year {} while the youngest customer was born in {}.'.format(int(ear_yob),int(lat_yob)))
-        msg = 'The most common year of birth was {}.'
-        print(msg.format(int(mode_yob)))
-    except:
-        print('No data for the year of birth are available in this data set.')
-
-    print("\nThis took %s seconds." % (time.time() - start_time))
+        # Display earliest, most recent, and most common year of birth (yob)
+        yob = agg.birth_year_stats()
+        if yob is not None:
+            ear_yob, lat_yob, mode_yob = yob
+            print('\nThe oldest customer at the time was born in the year {} while the youngest customer was born in {}.'.format(int(ear_yob),int(lat_yob)))
+            msg = 'The most common year of birth was {}.'
+            print(msg.format(int(mode_yob)))
+        else:
+            print('No data for the year of birth are available in this data set.')
+
+    print("\nThis took %s seconds." % timing.seconds)
     print('-'*60)
     input('[ENTER] to return to the selection menu.')
 
+
 def user_query(city, month, day):
     """ Starts an interaction with the user:
         a) presents current data selection according to passed arguments
@@ -407,25 +460,64 @@ def main():
             else:
                 print("Very well - let's restart:")
 
-        # Load data according to arguments: city data, filter by month and weekday
-        df = load_data(city, month, day)
+        # Load data according to arguments: city data, filter by month and weekday.
+        # The rows are loaded when the summary, the raw data or new statistics need them,
+        # all statistics are read from one set of aggregates - cached for selections seen before
+        key = selection_key(city, month, day)
+        df = None
+        agg = QUERY_CACHE.get(key, 'agg')
 
         # interaction loop: show statistics/results as requested by the user
         while True:
             # returns a string var for the following selection
             user_input = user_query(city, month, day)
+            if user_input in ['summary', 'raw'] and df is None:
+                df = load_data(city, month, day)
+            counts = None
+            if user_input == 'time' and agg is None:
+                # pure counts - answered from the data cube, no pass over the rows
+                # (without a cube they are computed from the rows below)
+                counts = QUERY_CACHE.get(key, 'counts')
+                if counts is None:
+                    counts = count_aggregates(city, month, day)
+                    if counts is not None:
+                        QUERY_CACHE.put(key, 'counts', counts)
             if user_input == 'summary':
                 data_summary(df)
             elif user_input == 'raw':
                 raw_data(df)
-            elif user_input == 'time':
-                time_stats(df)
-            elif user_input == 'station':
-                station_stats(df)
-            elif user_input == 'trip':
-                trip_duration_stats(df)
-            elif user_input == 'user':
-                user_stats(df)
+            elif counts is not None:
+                if counts.trips == 0:
+                    print('No bike trips were registered for this selection.')
+                else:
+                    time_stats(counts)
+            elif user_input in ['time', 'station', 'trip', 'user']:
+                if agg is None:
+                    if PROCESSES:
+                        agg = aggregate_data(city, month, day, PROCESSES)
+                    elif month == 'all' and day == 'all':
+                        agg = total_aggregates(city)
+                    else:
+                        if df is None:
+                            df = load_data(city, month, day)
+                        agg = BikeshareAggregates.from_frame(df)
+                    QUERY_CACHE.put(key, 'agg', agg)
+                if agg.trips == 0:
+                    print('No bike trips were registered for this selection.')
+                elif user_input == 'time':
+                    time_stats(agg)
+                elif user_input == 'station':
+                    station_stats(agg)
+                elif user_input == 'trip':
+                    durations = QUERY_CACHE.get(key, 'durations')
+                    if durations is None:
+                        if df is None:
+                            df = load_data(city, month, day)
+                        durations = DurationStats.from_frame(df)
+                        QUERY_CACHE.put(key, 'durations', durations)
+                    trip_duration_stats(agg, durations)
+                else:
+                    user_stats(agg)
             elif user_input in ['exit','restart']:
                 print('Alright...')
                 break
@@ -438,4 +530,8 @@ def main():
             print('        ... restarting\n          ..\n           .')
 
 if __name__ == "__main__":
+	# with command line arguments: non-interactive batch mode, see batch.py
+	if len(sys.argv) > 1:
+		import batch
+		sys.exit(batch.main(sys.argv[1:]))
 	main()
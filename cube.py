@@ -0,0 +1,254 @@
+""" Precomputed data cube of trip counts.
+
+    Most questions about the data are plain counts over a few low-cardinality
+    dimensions. The cube holds the number of trips (and the sum and number
+    of their known durations) for every combination of
+
+        city x month (12) x weekday (7) x start hour (24) x user type x gender
+
+    and is persisted next to the columnar stores. Any city/month/day selection
+    is then answered by slicing and summing the cube, without touching the
+    row-level data. Missing user types and genders are counted under
+    'Unknown'; cities without a gender column are flagged as such.
+    New files of a city (see ingest.py) are added to the persisted cube
+    without rebuilding it. Once loaded, the cube stays in memory for as long
+    as the files it was built from are unchanged.
+"""
+import json
+import os
+import zipfile
+
+import numpy as np
+
+import instrument
+import store
+from aggregates import BikeshareAggregates, NS_PER_HOUR
+
+CUBE_VERSION = 2
+UNKNOWN = 'Unknown'
+
+# cubes loaded by get_cube, by file name
+_cubes = {}
+
+
+def cube_path(cache_dir=None):
+    """ Returns the file name (without extension) of the persisted cube. """
+    return os.path.join(cache_dir or store.CACHE_DIR, 'cube')
+
+
+class CountCube:
+    """ Dense trip count and duration sum arrays over city x month x weekday x hour x user type x gender. """
+
+    def __init__(self, cities, user_types, genders, has_gender, counts, duration_sums, duration_counts,
+                 sources=None):
+        self.cities = list(cities)
+        self.user_types = list(user_types)
+        self.genders = list(genders)
+        self.has_gender = list(has_gender)
+        self.counts = counts
+        self.duration_sums = duration_sums
+        # trips with a known duration - the mean leaves missing durations out, like from_frame
+        self.duration_counts = duration_counts
+        self.sources = sources or {}
+
+    @property
+    def shape(self):
+        return (len(self.cities), 12, 7, 24, len(self.user_types), len(self.genders))
+
+    @classmethod
+    def build(cls, sources, cache_dir=None):
+        """ Builds the cube from the columnar stores of several city files.
+            Args:
+                (dict) sources - label (e.g. 'Chicago') -> csv path or list of segments
+            Returns:
+                CountCube
+        """
+        stores = {}
+        for label, source in sources.items():
+            stores[label] = [store.get_store(path, cache_dir, after) for path, after in store.segments(source)]
+            if any(city_store is None for city_store in stores[label]):
+                raise OSError('no columnar store available for {}'.format(label))
+        all_stores = [city_store for parts in stores.values() for city_store in parts]
+        user_types = sorted({c for st in all_stores for c in st.categories('User Type')}) + [UNKNOWN]
+        genders = sorted({c for st in all_stores if 'Gender' in st.columns for c in st.categories('Gender')}) + [UNKNOWN]
+        has_gender = [any('Gender' in st.columns for st in parts) for parts in stores.values()]
+        cube = cls(sources, user_types, genders, has_gender, None, None, None,
+                   {label: store.segments_key(source) for label, source in sources.items()})
+        cube.counts = np.zeros(cube.shape, dtype=np.int64)
+        cube.duration_sums = np.zeros(cube.shape, dtype=np.float64)
+        cube.duration_counts = np.zeros(cube.shape, dtype=np.int64)
+        for i, parts in enumerate(stores.values()):
+            for city_store in parts:
+                cube._add_store(i, city_store)
+        return cube
+
+    def _add_store(self, city, city_store):
+        """ Adds the trips of one store to the counts of a city. """
+        with instrument.stage('cube', rows=city_store.n_rows):
+            index = self._flat_index(city, city_store)
+            duration = np.asarray(city_store.array('Trip Duration'), dtype=np.float64)
+            known = ~np.isnan(duration)
+            size = self.counts.size
+            self.counts += np.bincount(index, minlength=size).reshape(self.shape)
+            self.duration_sums += np.bincount(index[known], weights=duration[known], minlength=size).reshape(self.shape)
+            self.duration_counts += np.bincount(index[known], minlength=size).reshape(self.shape)
+
+    def _extend_axis(self, axis, vocabulary, names):
+        """ Grows the user type or gender axis by new names, the counts move along.
+            Returns:
+                (list) the extended vocabulary, 'Unknown' stays last
+        """
+        extended = sorted(set(vocabulary[:-1]) | set(names)) + [UNKNOWN]
+        if extended == vocabulary:
+            return vocabulary
+        shape = list(self.counts.shape)
+        shape[axis] = len(extended)
+        target = [slice(None)] * len(shape)
+        target[axis] = [extended.index(name) for name in vocabulary]
+        for attr in ('counts', 'duration_sums', 'duration_counts'):
+            grown = np.zeros(shape, dtype=getattr(self, attr).dtype)
+            grown[tuple(target)] = getattr(self, attr)
+            setattr(self, attr, grown)
+        return extended
+
+    def add(self, label, city_store, source):
+        """ Adds a new segment of a city (see ingest.py) to the cube without rebuilding it.
+            Args:
+                (str) label - city label, one of self.cities
+                city_store - CityStore of the new segment
+                source - all segments of the city including the new one
+        """
+        i = self.cities.index(label)
+        self.user_types = self._extend_axis(4, self.user_types, city_store.categories('User Type'))
+        if 'Gender' in city_store.columns:
+            self.genders = self._extend_axis(5, self.genders, city_store.categories('Gender'))
+            self.has_gender[i] = True
+        self._add_store(i, city_store)
+        self.sources[label] = store.segments_key(source)
+
+    def _codes(self, city_store, column, vocabulary):
+        """ Maps the category codes of a store column onto a cube axis (missing -> 'Unknown'). """
+        unknown = vocabulary.index(UNKNOWN)
+        if column not in city_store.columns:
+            return np.full(city_store.n_rows, unknown, dtype=np.int64)
+        lookup = np.array([vocabulary.index(c) for c in city_store.categories(column)] + [unknown], dtype=np.int64)
+        return lookup[city_store.array(column)]
+
+    def _flat_index(self, city, city_store):
+        """ Returns the flat cube position of every row of a store. """
+        start_times = np.asarray(city_store.array('Start Time'))
+        month, weekday = store.time_codes(start_times)
+        hour = (start_times.view(np.int64) // NS_PER_HOUR) % 24
+        return np.ravel_multi_index((np.full(len(month), city), month.astype(np.int64) - 1, weekday, hour,
+                                     self._codes(city_store, 'User Type', self.user_types),
+                                     self._codes(city_store, 'Gender', self.genders)), self.shape)
+
+    # --- persistence
+    def save(self, cache_dir=None):
+        """ Writes the cube as .npz plus a .json file with its axis labels,
+            replaced in one step each (see BikeshareAggregates.save).
+        """
+        path = cube_path(cache_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        token = os.urandom(8).hex()
+        store.write_atomic(path + '.npz', lambda f: np.savez(
+            f, token=token, counts=self.counts, duration_sums=self.duration_sums,
+            duration_counts=self.duration_counts), binary=True)
+        meta = {'version': CUBE_VERSION, 'token': token, 'cities': self.cities, 'user_types': self.user_types,
+                'genders': self.genders, 'has_gender': self.has_gender, 'sources': self.sources}
+        store.write_atomic(path + '.json', lambda f: json.dump(meta, f))
+
+    @classmethod
+    def load(cls, cache_dir=None):
+        """ Reads a persisted cube, returns None if there is none (or it is outdated or unreadable). """
+        path = cube_path(cache_dir)
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            if meta.get('version') != CUBE_VERSION:
+                return None
+            with np.load(path + '.npz') as arrays:
+                if str(arrays['token']) != meta['token']:
+                    return None
+                return cls(meta['cities'], meta['user_types'], meta['genders'], meta['has_gender'],
+                           arrays['counts'], arrays['duration_sums'], arrays['duration_counts'], meta['sources'])
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+
+    # --- queries
+    @staticmethod
+    def _slices(month=None, day=None):
+        """ Returns the slices of the month and the weekday axis covering a selection. """
+        return (slice(None) if month is None else slice(month - 1, month),
+                slice(None) if day is None else slice(day, day + 1))
+
+    def select(self, city=None, month=None, day=None):
+        """ Slices the cube down to a selection.
+            Args:
+                (str) city - city label (e.g. 'Chicago'), or None for all cities
+                (int) month - month number 1...12, or None for no month filter
+                (int) day - weekday number 0 (Monday) ... 6, or None for no day filter
+            Returns:
+                count and duration sum arrays of shape month x weekday x hour x
+                user type x gender (cities summed up, the month and weekday
+                axes cut down to the selected month and weekday), and the
+                number of trips of the selection with a known duration
+        """
+        i = None if city is None else self.cities.index(city)
+        index = (slice(None) if i is None else slice(i, i + 1),) + self._slices(month, day)
+        return (self.counts[index].sum(axis=0), self.duration_sums[index].sum(axis=0),
+                int(self.duration_counts[index].sum()))
+
+    def aggregates(self, city=None, month=None, day=None):
+        """ Answers a selection as BikeshareAggregates with the count based fields filled in:
+            trips, month/weekday/hour counts, user type and gender counts and
+            the duration total/mean. Station counts, the longest trip and the
+            years of birth are not part of the cube.
+            Args: see select()
+            Returns:
+                BikeshareAggregates
+        """
+        counts, sums, known = self.select(city, month, day)
+        months, days = self._slices(month, day)
+        agg = BikeshareAggregates()
+        agg.trips = int(counts.sum())
+        agg.month_counts = np.zeros(13, dtype=np.int64)
+        agg.month_counts[1:][months] = counts.sum(axis=(1, 2, 3, 4))
+        agg.weekday_counts = np.zeros(7, dtype=np.int64)
+        agg.weekday_counts[days] = counts.sum(axis=(0, 2, 3, 4))
+        agg.hour_counts = counts.sum(axis=(0, 1, 3, 4))
+        by_type = counts.sum(axis=(0, 1, 2, 4))
+        agg.user_types = {name: int(n) for name, n in zip(self.user_types, by_type) if n > 0 and name != UNKNOWN}
+        with_gender = self.has_gender if city is None else [self.has_gender[self.cities.index(city)]]
+        if any(with_gender):
+            by_gender = counts.sum(axis=(0, 1, 2, 3))
+            agg.genders = {name: int(n) for name, n in zip(self.genders, by_gender) if n > 0 and name != UNKNOWN}
+        agg.duration_count = known
+        agg.duration_sum = float(sums.sum())
+        return agg
+
+
+def get_cube(sources, cache_dir=None):
+    """ Returns the cube of the given city files: the one already in memory, else the
+        persisted one, else a new one that gets built (and saved) first.
+        Args:
+            (dict) sources - label (e.g. 'Chicago') -> csv path or list of segments
+        Returns:
+            CountCube
+        Raises:
+            OSError - if the cube has to be built and the columnar stores are not available
+    """
+    path = cube_path(cache_dir)
+    current = {label: store.segments_key(source) for label, source in sources.items()}
+    cube = _cubes.get(path)
+    if cube is not None and cube.sources == current:
+        return cube
+    cube = CountCube.load(cache_dir)
+    if cube is None or cube.sources != current:
+        cube = CountCube.build(sources, cache_dir)
+        try:
+            cube.save(cache_dir)
+        except OSError:
+            pass
+    _cubes[path] = cube
+    return cube
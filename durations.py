@@ -0,0 +1,314 @@
+""" Trip duration distributions per city, month, weekday, hour and user type.
+
+    DurationStats describes the trip durations of every group of
+
+        all (one group), city, month, weekday, start hour, user type
+
+    by trip count, mean, quantiles (p50/p90/p99), the number of outliers and
+    a histogram on logarithmic bins - all groups in one vectorized pass:
+
+      - from_frame sorts the durations once; a stable sort by group code
+        (a radix sort on small integers) then lays out every group's durations
+        in order, so exact quantiles are positions in that array and outliers
+        a single comparison against per-group fences
+      - the log-binned histograms (BINS_PER_DECADE bins per factor 10) are
+        kept as well and simply add up, so chunks and partitions can be
+        merged; quantiles of merged statistics are read from the histograms,
+        which is exact up to the relative bin width (about 5 %)
+
+    Outliers are trips outside the Tukey fences [Q1 - k * IQR, Q3 + k * IQR]
+    of their group with k = OUTLIER_IQR.
+"""
+import calendar
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import instrument
+import store
+from aggregates import NS_PER_HOUR, _categories, _category_codes
+
+QUANTILES = (0.25, 0.5, 0.75, 0.9, 0.99)
+REPORTED = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+OUTLIER_IQR = 1.5
+# histogram bins: BINS_PER_DECADE per factor 10 from 1 second to 10**DECADES seconds,
+# shorter and longer trips are counted in the first and last bin
+BINS_PER_DECADE = 50
+DECADES = 7
+N_BINS = BINS_PER_DECADE * DECADES
+BIN_EDGES = np.logspace(0, DECADES, N_BINS + 1)
+DIMENSIONS = ('all', 'city', 'month', 'weekday', 'hour', 'user_type')
+FIXED_GROUPS = {'all': ['all'],
+                'month': list(calendar.month_name[1:]),
+                'weekday': list(calendar.day_name),
+                'hour': list(range(24))}
+
+
+def duration_bins(durations):
+    """ Returns the log histogram bin of every duration in seconds. """
+    logs = np.log10(np.maximum(durations, 1.0)) * BINS_PER_DECADE
+    return np.clip(logs.astype(np.int64), 0, N_BINS - 1)
+
+
+def format_durations(seconds):
+    """ Formats an array of durations in seconds as 'H:MM:SS' strings in one go (NaN as '-'). """
+    seconds = np.asarray(seconds, dtype=np.float64)
+    whole = np.round(np.nan_to_num(seconds)).astype(np.int64)
+    hours, rest = np.divmod(whole, 3600)
+    minutes, secs = np.divmod(rest, 60)
+    text = (hours.astype(str).astype(object) + ':' + np.char.zfill(minutes.astype(str), 2).astype(object)
+            + ':' + np.char.zfill(secs.astype(str), 2).astype(object))
+    return np.where(np.isnan(seconds), '-', text).tolist()
+
+
+def _sorted_quantiles(values, lo, hi, q):
+    """ Linearly interpolated quantile q of every group of a group-wise sorted array. """
+    n = hi - lo
+    position = lo + q * np.maximum(n - 1, 0)
+    below = np.floor(position).astype(np.int64)
+    above = np.minimum(below + 1, np.maximum(hi - 1, 0))
+    below = np.minimum(below, len(values) - 1)
+    frac = position - below
+    result = values[below] + frac * (values[above] - values[below]) if len(values) else np.zeros(len(n))
+    return np.where(n > 0, result, np.nan)
+
+
+def _histogram_quantiles(histogram, q, minimum, maximum):
+    """ Quantile q of every group (row) of a histogram, interpolated log-linearly within its bin. """
+    cumulative = np.cumsum(histogram, axis=1)
+    n = cumulative[:, -1]
+    rank = q * np.maximum(n - 1, 0)
+    bins = np.array([np.searchsorted(row, r, side='right') for row, r in zip(cumulative, rank)], dtype=np.int64)
+    bins = np.minimum(bins, N_BINS - 1)
+    before = np.where(bins > 0, cumulative[np.arange(len(bins)), bins - 1], 0)
+    inside = np.maximum(histogram[np.arange(len(bins)), bins], 1)
+    frac = np.clip((rank - before + 0.5) / inside, 0, 1)
+    values = BIN_EDGES[bins] * (BIN_EDGES[bins + 1] / BIN_EDGES[bins]) ** frac
+    return np.where(n > 0, np.clip(values, minimum, maximum), np.nan)
+
+
+class DurationStats:
+    """ Duration distribution of every group of DIMENSIONS, see the module docstring. """
+    __slots__ = ('groups', 'histograms', 'sums', 'minima', 'maxima', 'quantiles', 'outliers')
+
+    def __init__(self):
+        # per dimension: group names and per-group arrays
+        self.groups = {}
+        self.histograms = {}
+        self.sums = {}
+        self.minima = {}
+        self.maxima = {}
+        # exact quantiles (groups x QUANTILES) and outlier counts, None once merged
+        self.quantiles = {}
+        self.outliers = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        """ Computes the duration statistics of a DataFrame as returned by load_data.
+            Args:
+                df - Pandas DataFrame containing filtered or unfiltered dataset
+            Returns:
+                DurationStats
+        """
+        with instrument.stage('durations', rows=len(df)):
+            return cls._from_frame(df)
+
+    @classmethod
+    def _from_frame(cls, df):
+        stats = cls()
+        duration = df['Trip Duration'].to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = ~np.isnan(duration)
+        start_times = np.asarray(df['Start Time'], dtype='datetime64[ns]')
+        month, weekday = store.time_codes(start_times)
+        codes = {'all': (np.zeros(len(df), dtype=np.int16), FIXED_GROUPS['all']),
+                 'month': (month.astype(np.int16) - 1, FIXED_GROUPS['month']),
+                 'weekday': (weekday.astype(np.int16), FIXED_GROUPS['weekday']),
+                 'hour': (((start_times.view(np.int64) // NS_PER_HOUR) % 24).astype(np.int16), FIXED_GROUPS['hour'])}
+        for dimension, column in (('city', 'City'), ('user_type', 'User Type')):
+            if column in df.columns:
+                names = _categories(df[column])
+                codes[dimension] = (_category_codes(df[column], names).astype(np.int16), names)
+
+        # sort once by duration, then stably by group: durations stay sorted within every group
+        duration = duration[valid]
+        order = np.argsort(duration, kind='stable')
+        ordered = duration[order]
+        bins = duration_bins(ordered)
+        for dimension, (group_codes, names) in codes.items():
+            group_codes = group_codes[valid][order]
+            by_group = np.argsort(group_codes, kind='stable')
+            values, group_codes, group_bins = ordered[by_group], group_codes[by_group], bins[by_group]
+            n_groups = len(names)
+            lo = np.searchsorted(group_codes, np.arange(n_groups), side='left')
+            hi = np.searchsorted(group_codes, np.arange(n_groups), side='right')
+            known = group_codes >= 0
+            stats.groups[dimension] = list(names)
+            stats.histograms[dimension] = np.bincount(group_codes[known].astype(np.int64) * N_BINS + group_bins[known],
+                                                      minlength=n_groups * N_BINS).reshape(n_groups, N_BINS)
+            stats.sums[dimension] = np.bincount(group_codes[known], weights=values[known], minlength=n_groups)
+            stats.minima[dimension] = np.where(hi > lo, values[np.minimum(lo, len(values) - 1)] if len(values) else 0, np.nan)
+            stats.maxima[dimension] = np.where(hi > lo, values[np.maximum(hi - 1, 0)] if len(values) else 0, np.nan)
+            quantiles = np.column_stack([_sorted_quantiles(values, lo, hi, q) for q in QUANTILES])
+            stats.quantiles[dimension] = quantiles
+            stats.outliers[dimension] = cls._count_outliers(values[known], group_codes[known], quantiles, n_groups)
+        return stats
+
+    @staticmethod
+    def _count_outliers(values, group_codes, quantiles, n_groups):
+        """ Counts the values outside the Tukey fences of their group. """
+        q1, q3 = quantiles[:, QUANTILES.index(0.25)], quantiles[:, QUANTILES.index(0.75)]
+        iqr = q3 - q1
+        lower, upper = q1 - OUTLIER_IQR * iqr, q3 + OUTLIER_IQR * iqr
+        outside = (values < lower[group_codes]) | (values > upper[group_codes])
+        return np.bincount(group_codes[outside], minlength=n_groups).astype(np.int64)
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """ Computes the statistics chunk by chunk, e.g. over load_data(..., chunksize=n).
+            Quantiles and outliers then come from the merged histograms.
+        """
+        stats = cls()
+        for chunk in chunks:
+            stats = stats.merge(cls.from_frame(chunk))
+        return stats
+
+    @property
+    def trips(self):
+        return int(self.histograms['all'].sum()) if 'all' in self.histograms else 0
+
+    def merge(self, other):
+        """ Combines the statistics of two disjoint parts of the data.
+            Returns:
+                DurationStats - new object, histogram based from now on
+        """
+        if other.trips == 0:
+            return self
+        if self.trips == 0:
+            return other
+        stats = DurationStats()
+        for dimension in DIMENSIONS:
+            parts = [part for part in (self, other) if dimension in part.groups]
+            if not parts:
+                continue
+            names = FIXED_GROUPS.get(dimension) or sorted(set().union(*[part.groups[dimension] for part in parts]))
+            n_groups = len(names)
+            stats.groups[dimension] = list(names)
+            stats.histograms[dimension] = np.zeros((n_groups, N_BINS), dtype=np.int64)
+            stats.sums[dimension] = np.zeros(n_groups)
+            stats.minima[dimension] = np.full(n_groups, np.nan)
+            stats.maxima[dimension] = np.full(n_groups, np.nan)
+            for part in parts:
+                ids = np.array([names.index(name) for name in part.groups[dimension]], dtype=np.int64)
+                stats.histograms[dimension][ids] += part.histograms[dimension]
+                stats.sums[dimension][ids] += part.sums[dimension]
+                stats.minima[dimension][ids] = np.fmin(stats.minima[dimension][ids], part.minima[dimension])
+                stats.maxima[dimension][ids] = np.fmax(stats.maxima[dimension][ids], part.maxima[dimension])
+            stats.quantiles[dimension] = None
+            stats.outliers[dimension] = None
+        return stats
+
+    def _quantiles(self, dimension):
+        """ Returns the quantiles (groups x QUANTILES) of a dimension, exact if available. """
+        if self.quantiles.get(dimension) is not None:
+            return self.quantiles[dimension]
+        return np.column_stack([_histogram_quantiles(self.histograms[dimension], q, self.minima[dimension],
+                                                     self.maxima[dimension]) for q in QUANTILES])
+
+    def _outliers(self, dimension):
+        """ Returns the outlier counts of a dimension, from the histogram bins if not exact. """
+        if self.outliers.get(dimension) is not None:
+            return self.outliers[dimension]
+        quantiles = self._quantiles(dimension)
+        histogram = self.histograms[dimension]
+        q1, q3 = quantiles[:, QUANTILES.index(0.25)], quantiles[:, QUANTILES.index(0.75)]
+        lower, upper = q1 - OUTLIER_IQR * (q3 - q1), q3 + OUTLIER_IQR * (q3 - q1)
+        # a bin counts as outside if it lies entirely outside a fence
+        outside = (BIN_EDGES[1:][None, :] <= lower[:, None]) | (BIN_EDGES[:-1][None, :] > upper[:, None])
+        return (histogram * outside).sum(axis=1)
+
+    def table(self, dimension='all'):
+        """ Returns the distribution of every group of a dimension as DataFrame.
+            Args:
+                (str) dimension - one of DIMENSIONS
+            Returns:
+                df - one row per group with trips, mean, p50, p90, p99 (seconds) and outliers
+        """
+        trips = self.histograms[dimension].sum(axis=1)
+        quantiles = self._quantiles(dimension)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            data = {'trips': trips, 'mean': np.where(trips > 0, self.sums[dimension] / trips, np.nan)}
+        for name, q in REPORTED.items():
+            data[name] = quantiles[:, QUANTILES.index(q)]
+        data['outliers'] = self._outliers(dimension)
+        return pd.DataFrame(data, index=pd.Index(self.groups[dimension], name=dimension))
+
+    def histogram(self, dimension='all', group='all'):
+        """ Returns the log-binned histogram of one group.
+            Returns:
+                (tuple) bin edges in seconds (n + 1) and trip counts (n), trimmed to the occupied bins
+        """
+        counts = self.histograms[dimension][self.groups[dimension].index(group)]
+        occupied = np.flatnonzero(counts)
+        if len(occupied) == 0:
+            return BIN_EDGES[:1], counts[:0]
+        lo, hi = occupied[0], occupied[-1] + 1
+        return BIN_EDGES[lo:hi + 1], counts[lo:hi]
+
+    def to_dict(self):
+        """ Returns all groups with at least one trip as nested plain dictionary (for JSON). """
+        result = {}
+        for dimension in DIMENSIONS:
+            if dimension not in self.groups:
+                continue
+            table = self.table(dimension)
+            table = table[table['trips'] > 0]
+            result[dimension] = {str(group): {key: (int(value) if key in ('trips', 'outliers') else float(value))
+                                              for key, value in row.items()} for group, row in table.iterrows()}
+        return result
+
+    # --- persistence
+    def save(self, path, sources=None):
+        """ Writes the statistics as .npz plus a .json file with the group names,
+            replaced in one step each (see BikeshareAggregates.save).
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        token = os.urandom(8).hex()
+        arrays = {'token': token}
+        for dimension in self.groups:
+            for name in ('histograms', 'sums', 'minima', 'maxima', 'quantiles', 'outliers'):
+                values = getattr(self, name)[dimension]
+                if values is not None:
+                    arrays['{}_{}'.format(dimension, name)] = values
+        store.write_atomic(path + '.npz', lambda f: np.savez(f, **arrays), binary=True)
+        store.write_atomic(path + '.json', lambda f: json.dump({'token': token, 'groups': self.groups,
+                                                                'sources': sources}, f))
+
+    @classmethod
+    def load(cls, path):
+        """ Reads statistics written by save().
+            Returns:
+                DurationStats and the sources they were saved with, (None, None) if unreadable
+        """
+        stats = cls()
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            with np.load(path + '.npz') as arrays:
+                if str(arrays['token']) != meta['token']:
+                    return None, None
+                stats.groups = meta['groups']
+                for dimension in stats.groups:
+                    for name in ('histograms', 'sums', 'minima', 'maxima', 'quantiles', 'outliers'):
+                        key = '{}_{}'.format(dimension, name)
+                        getattr(stats, name)[dimension] = arrays[key] if key in arrays else None
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None, None
+        return stats, meta['sources']
+
+    def nbytes(self):
+        """ Returns the memory taken by the arrays of the statistics. """
+        return sum(values.nbytes for name in ('histograms', 'sums', 'minima', 'maxima', 'quantiles', 'outliers')
+                   for values in getattr(self, name).values() if values is not None)
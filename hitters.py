@@ -0,0 +1,332 @@
+""" Top-K (heavy hitter) counting of stations, trips and years of birth.
+
+    BikeshareAggregates keeps a count for every station and every station pair
+    it has seen, which is exact but grows with the number of distinct keys.
+    HeavyHitters answers the top-N questions - start stations, end stations,
+    trips and years of birth - in one of two modes:
+
+      exact        hash counts: every key (a 64-bit hash of the station name,
+                   of the station pair, or the year itself) with its count
+      approximate  a Count-Min sketch plus a Space-Saving summary of a fixed
+                   number of counters per question, so memory stays bounded
+                   no matter how many keys there are
+
+    Both modes are mergeable: chunks, partitions or processes can be counted
+    separately and combined with merge(). In approximate mode every reported
+    count comes with an error - the true count lies in [count - error, count] -
+    and error_bounds() gives the bounds of the whole summary.
+
+        hh = HeavyHitters.from_chunks(load_data('all', 'all', 'all', chunksize=100000), approximate=True)
+        hh.top('start_station', 5)
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+DIMENSIONS = ('start_station', 'end_station', 'trip', 'birth_year')
+# counters per Space-Saving summary, and the Count-Min sketch accuracy:
+# estimates exceed the true count by at most EPSILON * total with probability 1 - DELTA
+DEFAULT_CAPACITY = 1000
+DEFAULT_EPSILON = 0.0002
+DEFAULT_DELTA = 0.01
+# mixes two station hashes into the key of an (undirected) trip
+PAIR_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _count_keys(keys):
+    """ Returns the distinct keys of a batch, the position of their first occurrence and their counts. """
+    return np.unique(np.asarray(keys, dtype=np.uint64), return_index=True, return_counts=True)
+
+
+class CountMinSketch:
+    """ Count-Min sketch: depth rows of width counters, one multiply-shift hash per row.
+        An estimate never undercounts and overcounts by at most
+        e / width * total with probability 1 - exp(-depth).
+    """
+
+    def __init__(self, width, depth, seed=0):
+        self.bits = max(1, int(math.ceil(math.log2(width))))
+        self.width = 2 ** self.bits
+        self.depth = depth
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # multiply-shift hashing needs odd multipliers
+        self.a = rng.integers(0, 2**63, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 2**63, size=depth, dtype=np.uint64)
+        self.table = np.zeros((depth, self.width), dtype=np.int64)
+        self.total = 0
+
+    @classmethod
+    def from_error(cls, epsilon=DEFAULT_EPSILON, delta=DEFAULT_DELTA, seed=0):
+        """ Returns a sketch sized for an overcount of at most epsilon * total with probability 1 - delta. """
+        return cls(int(math.ceil(math.e / epsilon)), int(math.ceil(math.log(1 / delta))), seed)
+
+    def _buckets(self, row, keys):
+        return ((keys * self.a[row] + self.b[row]) >> np.uint64(64 - self.bits)).astype(np.int64)
+
+    def update(self, keys, counts):
+        """ Adds counts of (distinct) keys. """
+        keys = np.asarray(keys, dtype=np.uint64)
+        for row in range(self.depth):
+            self.table[row] += np.bincount(self._buckets(row, keys), weights=counts, minlength=self.width).astype(np.int64)
+        self.total += int(np.sum(counts))
+
+    def estimate(self, keys):
+        """ Returns the estimated counts of an array of keys. """
+        keys = np.asarray(keys, dtype=np.uint64)
+        return np.min([self.table[row][self._buckets(row, keys)] for row in range(self.depth)], axis=0)
+
+    def merge(self, other):
+        """ Returns the sketch of both inputs, which must have been created with the same parameters. """
+        if (self.width, self.depth, self.seed) != (other.width, other.depth, other.seed):
+            raise ValueError('Count-Min sketches of different shape or seed cannot be merged')
+        merged = CountMinSketch(self.width, self.depth, self.seed)
+        merged.table = self.table + other.table
+        merged.total = self.total + other.total
+        return merged
+
+    def error_bound(self):
+        """ Returns the maximal overcount (with probability 1 - exp(-depth)). """
+        return math.e / self.width * self.total
+
+
+class SpaceSaving:
+    """ Space-Saving summary: at most capacity monitored keys with count and error.
+        A monitored key's true count lies in [count - error, count], a key that
+        is not monitored occurs at most floor times (floor <= total / capacity).
+        Batches are added by merging their exact counts (mergeable summaries,
+        Agarwal et al. 2012), so the summary is independent of the batch order
+        up to ties.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.errors = np.zeros(0, dtype=np.int64)
+        self.total = 0
+
+    @property
+    def floor(self):
+        """ Upper bound of the count of any key that is not monitored. """
+        return int(self.counts.min()) if len(self.keys) >= self.capacity else 0
+
+    @classmethod
+    def from_counts(cls, keys, counts, capacity=DEFAULT_CAPACITY):
+        """ Returns the summary of exactly counted (distinct) keys. """
+        summary = cls(capacity)
+        summary.keys = np.asarray(keys, dtype=np.uint64)
+        summary.counts = np.asarray(counts, dtype=np.int64)
+        summary.errors = np.zeros(len(summary.keys), dtype=np.int64)
+        summary.total = int(summary.counts.sum())
+        summary._truncate()
+        return summary
+
+    def _truncate(self):
+        """ Keeps the capacity largest counters. """
+        if len(self.keys) > self.capacity:
+            keep = np.argsort(-self.counts, kind='stable')[:self.capacity]
+            self.keys, self.counts, self.errors = self.keys[keep], self.counts[keep], self.errors[keep]
+
+    def merge(self, other):
+        """ Returns the summary of both inputs: keys missing on one side are counted with
+            that side's floor (and the floor is added to their error).
+        """
+        if other.capacity != self.capacity:
+            raise ValueError('Space-Saving summaries of different capacity cannot be merged')
+        keys = np.concatenate([self.keys, other.keys])
+        distinct, inverse = np.unique(keys, return_inverse=True)
+        counts = np.zeros(len(distinct), dtype=np.int64)
+        errors = np.zeros(len(distinct), dtype=np.int64)
+        np.add.at(counts, inverse, np.concatenate([self.counts, other.counts]))
+        np.add.at(errors, inverse, np.concatenate([self.errors, other.errors]))
+        for part in (self, other):
+            missing = ~np.isin(distinct, part.keys)
+            counts[missing] += part.floor
+            errors[missing] += part.floor
+        merged = SpaceSaving(self.capacity)
+        merged.keys, merged.counts, merged.errors = distinct, counts, errors
+        merged.total = self.total + other.total
+        merged._truncate()
+        return merged
+
+
+class TopK:
+    """ Counts of the keys of one question plus the names of the keys that can be reported. """
+
+    def __init__(self, approximate=False, capacity=DEFAULT_CAPACITY, epsilon=DEFAULT_EPSILON, delta=DEFAULT_DELTA):
+        self.approximate = approximate
+        self.names = {}
+        if approximate:
+            self.summary = SpaceSaving(capacity)
+            self.sketch = CountMinSketch.from_error(epsilon, delta)
+        else:
+            self.keys = np.zeros(0, dtype=np.uint64)
+            self.counts = np.zeros(0, dtype=np.int64)
+
+    @property
+    def total(self):
+        return self.summary.total if self.approximate else int(self.counts.sum())
+
+    def update(self, keys, label):
+        """ Counts a batch of keys.
+            Args:
+                (array) keys - one uint64 key per row
+                label - function mapping row positions of the batch to the names of their keys
+        """
+        distinct, first, counts = _count_keys(keys)
+        if self.approximate:
+            self.sketch.update(distinct, counts)
+            self.summary = self.summary.merge(SpaceSaving.from_counts(distinct, counts, self.summary.capacity))
+            wanted = self.summary.keys
+        else:
+            merged, inverse = np.unique(np.concatenate([self.keys, distinct]), return_inverse=True)
+            self.counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts]),
+                                      minlength=len(merged)).astype(np.int64)
+            self.keys = merged
+            wanted = distinct
+        # name only the keys that are kept and not named yet
+        new = np.isin(distinct, wanted) & ~np.isin(distinct, np.fromiter(self.names, dtype=np.uint64, count=len(self.names)))
+        self.names.update(zip(distinct[new].tolist(), label(first[new])))
+        if self.approximate:
+            self.names = {key: self.names[key] for key in self.summary.keys.tolist()}
+
+    def merge(self, other):
+        """ Returns the counts of both inputs (same mode and parameters). """
+        merged = TopK(self.approximate)
+        if self.approximate:
+            merged.summary = self.summary.merge(other.summary)
+            merged.sketch = self.sketch.merge(other.sketch)
+            names = {**self.names, **other.names}
+            merged.names = {key: names[key] for key in merged.summary.keys.tolist()}
+        else:
+            keys, inverse = np.unique(np.concatenate([self.keys, other.keys]), return_inverse=True)
+            merged.keys = keys
+            merged.counts = np.bincount(inverse, weights=np.concatenate([self.counts, other.counts]),
+                                        minlength=len(keys)).astype(np.int64)
+            merged.names = {**self.names, **other.names}
+        return merged
+
+    def top(self, n):
+        """ Returns the n most common keys as (name, count, error) tuples, ties by name.
+            The true count lies in [count - error, count]; error is 0 in exact mode.
+        """
+        if self.approximate:
+            keys = self.summary.keys
+            # both estimates overcount - the smaller one is the tighter upper bound
+            counts = np.minimum(self.summary.counts, self.sketch.estimate(keys))
+            lower = np.maximum(self.summary.counts - self.summary.errors, 0)
+            errors = counts - np.minimum(lower, counts)
+        else:
+            keys, counts = self.keys, self.counts
+            errors = np.zeros(len(keys), dtype=np.int64)
+        if n <= 0 or len(keys) == 0:
+            return []
+        # every key tied with the n-th largest count is a candidate
+        threshold = np.sort(counts)[-min(n, len(counts))]
+        candidates = np.flatnonzero(counts >= threshold)
+        rows = sorted(((self.names[int(keys[i])], int(counts[i]), int(errors[i])) for i in candidates),
+                      key=lambda row: (-row[1], row[0]))
+        return rows[:n]
+
+    def error_bounds(self):
+        """ Returns the bounds of the whole summary: the largest count a key missing from
+            the summary can have, and the overcount bound of the Count-Min sketch.
+        """
+        if not self.approximate:
+            return {'total': self.total, 'unmonitored_max': 0, 'sketch_error': 0.0}
+        return {'total': self.total, 'unmonitored_max': self.summary.floor, 'sketch_error': self.sketch.error_bound()}
+
+
+def _text_keys(series):
+    """ Returns the uint64 hash key of every row of a text column, its codes and its categories.
+        Keys are hashes of the names, so they agree across chunks, partitions and processes.
+    """
+    cat = series.array if isinstance(series.dtype, pd.CategoricalDtype) else pd.Categorical(series)
+    categories = np.asarray([str(c) for c in cat.categories], dtype=object)
+    codes = np.asarray(cat.codes)
+    if len(categories) == 0:
+        return np.zeros(len(codes), dtype=np.uint64), codes, categories
+    # missing values (code -1) get some key, the callers leave those rows out
+    return pd.util.hash_array(categories)[np.maximum(codes, 0)], codes, categories
+
+
+class HeavyHitters:
+    """ Top-N start stations, end stations, trips and years of birth of a (filtered) DataFrame. """
+
+    def __init__(self, approximate=False, capacity=DEFAULT_CAPACITY, epsilon=DEFAULT_EPSILON, delta=DEFAULT_DELTA):
+        self.approximate = approximate
+        self.counters = {name: TopK(approximate, capacity, epsilon, delta) for name in DIMENSIONS}
+
+    @classmethod
+    def from_frame(cls, df, approximate=False, **options):
+        """ Counts the keys of a DataFrame as returned by load_data.
+            Args:
+                df - Pandas DataFrame containing filtered or unfiltered dataset
+                (bool) approximate - Count-Min sketch plus Space-Saving instead of exact counts
+                options - capacity, epsilon, delta of the approximate mode
+            Returns:
+                HeavyHitters
+        """
+        hh = cls(approximate, **options)
+        hh.update(df)
+        return hh
+
+    @classmethod
+    def from_chunks(cls, chunks, approximate=False, **options):
+        """ Counts the keys chunk by chunk, e.g. over load_data(..., chunksize=n). """
+        hh = cls(approximate, **options)
+        for chunk in chunks:
+            hh.update(chunk)
+        return hh
+
+    def update(self, df):
+        """ Adds the rows of a DataFrame to the counts. """
+        if len(df) == 0:
+            return
+        start, start_codes, start_names = _text_keys(df['Start Station'])
+        end, end_codes, end_names = _text_keys(df['End Station'])
+        for name, keys, codes, names in (('start_station', start, start_codes, start_names),
+                                         ('end_station', end, end_codes, end_names)):
+            valid = np.flatnonzero(codes >= 0)
+            self.counters[name].update(keys[valid], lambda rows, valid=valid, codes=codes, names=names:
+                                       names[codes[valid[rows]]].tolist())
+
+        # trips regardless of direction: the key of A > B equals the key of B > A
+        valid = np.flatnonzero((start_codes >= 0) & (end_codes >= 0))
+        low, high = np.minimum(start[valid], end[valid]), np.maximum(start[valid], end[valid])
+        with np.errstate(over='ignore'):
+            trip_keys = (low * PAIR_MULTIPLIER) ^ high
+
+        def trip_names(rows):
+            pairs = zip(start_names[start_codes[valid[rows]]], end_names[end_codes[valid[rows]]])
+            return [tuple(sorted(pair)) for pair in pairs]
+        self.counters['trip'].update(trip_keys, trip_names)
+
+        if 'Birth Year' in df.columns:
+            years = df['Birth Year'].to_numpy(dtype=np.float64, na_value=np.nan)
+            years = years[~np.isnan(years)].astype(np.int64)
+            self.counters['birth_year'].update(years.astype(np.uint64), lambda rows: years[rows].tolist())
+
+    def merge(self, other):
+        """ Returns the counts of two disjoint parts of the data (same mode and parameters). """
+        if other.approximate != self.approximate:
+            raise ValueError('exact and approximate heavy hitters cannot be merged')
+        hh = HeavyHitters(self.approximate)
+        hh.counters = {name: self.counters[name].merge(other.counters[name]) for name in DIMENSIONS}
+        return hh
+
+    def top(self, dimension, n=5):
+        """ Returns the n most common keys of a dimension as (name, count, error) tuples.
+            Args:
+                (str) dimension - 'start_station', 'end_station', 'trip' or 'birth_year'
+                (int) n - number of keys
+            Returns:
+                (list) names are station names, (station A, station B) pairs or years
+        """
+        return self.counters[dimension].top(n)
+
+    def error_bounds(self):
+        """ Returns the error bounds of every dimension, see TopK.error_bounds. """
+        return {name: counter.error_bounds() for name, counter in self.counters.items()}
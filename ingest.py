@@ -0,0 +1,183 @@
+""" Incremental ingestion of new trip files.
+
+    Providers publish new trips as further csv files (e.g. one per month).
+    Instead of replacing the file in CITY_DATA and recomputing everything, a
+    new file is registered as an additional segment of its city:
+
+        python ingest.py chicago Divvy_Trips_2017_Q3.csv
+
+    The new file gets a columnar store of its own, and the persisted results
+    - the per-city totals (BikeshareAggregates: counts, duration sums, OD
+    counts, years of birth) and the count cube - are updated by merging in
+    the aggregates of the new segment only. Adding a month therefore costs
+    time in proportion to that month, not to the whole history.
+
+    Every city keeps a watermark, the latest 'Start Time' ingested so far.
+    Trips of a new file starting at or before it count as already ingested
+    and are left out, so overlapping exports are not counted twice; a file
+    that is registered again is ignored.
+
+    The registered segments are kept in ingest.json in the cache directory.
+    city_sources() combines them with CITY_DATA into the sources (label ->
+    csv path or list of segments) used by store.py, cube.py and parallel.py.
+"""
+import argparse
+import json
+import os
+import sys
+
+import cube
+import instrument
+import store
+from aggregates import BikeshareAggregates
+
+REGISTRY_FILE = 'ingest.json'
+
+
+def registry_path(cache_dir=None):
+    """ Returns the path of the segment registry. """
+    return os.path.join(cache_dir or store.CACHE_DIR, REGISTRY_FILE)
+
+
+def load_registry(cache_dir=None):
+    """ Returns the registry: label -> {'base': csv path, 'segments': [[csv path, watermark], ...],
+        'watermark': latest 'Start Time'}. Empty if nothing was ingested yet.
+    """
+    try:
+        with open(registry_path(cache_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_registry(registry, cache_dir=None):
+    """ Writes the registry, replacing the old file in one step. """
+    path = registry_path(cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    store.write_atomic(path, lambda f: json.dump(registry, f, indent=2))
+
+
+def _entry(registry, label, base_path):
+    """ Returns the registry entry of a city, a fresh one if its base file has changed. """
+    entry = registry.get(label)
+    if entry is None or entry['base'] != os.path.abspath(base_path):
+        entry = {'base': os.path.abspath(base_path), 'segments': [], 'watermark': None}
+    return entry
+
+
+def city_sources(city_data, cities=None, cache_dir=None):
+    """ Returns the sources of cities: their file from city_data plus all segments added later.
+        Args:
+            (dict) city_data - city name -> csv path, like CITY_DATA
+            (list) cities - names of the cities to include (default: all of city_data)
+        Returns:
+            (dict) label (e.g. 'Chicago') -> csv path, or list of segments if files were added
+    """
+    registry = load_registry(cache_dir)
+    sources = {}
+    for city in cities or city_data:
+        entry = _entry(registry, city.title(), city_data[city])
+        if entry['segments']:
+            sources[city.title()] = [(city_data[city], None)] + [tuple(segment) for segment in entry['segments']]
+        else:
+            sources[city.title()] = city_data[city]
+    return sources
+
+
+def totals_path(label, cache_dir=None):
+    """ Returns the file name (without extension) of the persisted totals of a city. """
+    return os.path.join(cache_dir or store.CACHE_DIR, 'totals', label.lower().replace(' ', '_'))
+
+
+def city_totals(label, source, cache_dir=None):
+    """ Returns the aggregates of all trips of a city, computing (and saving) them first if needed.
+        Args:
+            (str) label - city label, e.g. 'Chicago'
+            source - csv path or list of segments of the city
+        Returns:
+            BikeshareAggregates
+    """
+    path = totals_path(label, cache_dir)
+    agg, covered = BikeshareAggregates.load(path)
+    current = store.segments_key(source)
+    if agg is not None and covered == current:
+        return agg
+    agg = BikeshareAggregates.from_frame(store.read_city(source, cache_dir=cache_dir))
+    try:
+        agg.save(path, current)
+    except OSError:
+        pass
+    return agg
+
+
+def add_file(city, csv_path, city_data, cache_dir=None):
+    """ Registers a new csv file of a city and merges its trips into the persisted results.
+        Args:
+            (str) city - city name as in city_data, e.g. 'chicago'
+            (str) csv_path - path of the new file
+            (dict) city_data - city name -> csv path, like CITY_DATA
+        Returns:
+            (int) number of trips added - 0 if the file was registered before
+        Raises:
+            OSError - if the file cannot be read or the cache directory not be written
+    """
+    label = city.title()
+    registry = load_registry(cache_dir)
+    entry = _entry(registry, label, city_data[city])
+    csv_path = os.path.abspath(csv_path)
+    if csv_path == entry['base'] or csv_path in [path for path, _ in entry['segments']]:
+        return 0
+    old_source = [(city_data[city], None)] + [tuple(segment) for segment in entry['segments']]
+
+    watermark = entry['watermark']
+    if watermark is None:
+        base_store = store.get_store(city_data[city], cache_dir)
+        if base_store is None:
+            raise OSError('no columnar store available for {}'.format(city_data[city]))
+        watermark = base_store.meta['max_start']
+    with instrument.stage('ingest', bytes_read=os.path.getsize(csv_path)) as record:
+        segment = store.build_store(csv_path, cache_dir, after=watermark)
+        record.rows = segment.n_rows
+    new_source = old_source + [(csv_path, watermark)]
+    delta = BikeshareAggregates.from_frame(segment.to_frame())
+
+    # merge the delta where the persisted results cover exactly the previous segments,
+    # anything else is out of date anyway and rebuilt on its next use
+    path = totals_path(label, cache_dir)
+    totals, covered = BikeshareAggregates.load(path)
+    if totals is not None and covered == store.segments_key(old_source):
+        totals.merge(delta).save(path, store.segments_key(new_source))
+    count_cube = cube.CountCube.load(cache_dir)
+    if (count_cube is not None and label in count_cube.cities
+            and count_cube.sources[label] == store.segments_key(old_source)):
+        count_cube.add(label, segment, new_source)
+        count_cube.save(cache_dir)
+
+    entry['segments'].append([csv_path, watermark])
+    entry['watermark'] = segment.meta['max_start'] or watermark
+    registry[label] = entry
+    save_registry(registry, cache_dir)
+    return segment.n_rows
+
+
+def main(argv=None):
+    """ Command line entry point: python ingest.py CITY FILE [FILE ...] """
+    import bikeshare
+
+    parser = argparse.ArgumentParser(description='Add new trip files to a city of the bikeshare data browser.')
+    parser.add_argument('city', help="chicago, 'new york city' or washington")
+    parser.add_argument('files', nargs='+', help='csv files with the new trips, oldest first')
+    args = parser.parse_args(argv)
+
+    city = args.city.strip().lower()
+    if city not in bikeshare.CITY_DATA:
+        parser.error('unknown city {!r}, expected one of: {}'.format(city, ', '.join(bikeshare.CITY_DATA)))
+    for csv_path in args.files:
+        added = add_file(city, csv_path, bikeshare.CITY_DATA)
+        watermark = load_registry().get(city.title(), {}).get('watermark')
+        print('{}: {} trips added, {} ingested up to {}'.format(csv_path, added, city.title(), watermark))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+""" Lightweight instrumentation of the load/parse/filter/aggregate stages.
+
+    Code marks a stage either with the context manager
+
+        with instrument.stage('filter', rows=n) as record:
+            ...
+            record.rows = len(result)
+
+    or with the decorator @instrument.instrumented('load'). Every run of a
+    stage records its perf_counter duration, the number of rows processed,
+    the bytes read from files, the in-memory size of the data it returns and
+    the change in memory (of the resident set size of the process). A decorated function returning a generator (e.g. load_data in
+    streaming mode) is recorded when the generator is used up, with the time
+    spent producing its items. The collected records can be exported as JSON
+    or in the Prometheus text format.
+
+    Environment variables:
+        BIKESHARE_PROFILE - comma separated list of extra capture modes:
+                            'tracemalloc' (memory deltas and peaks of traced
+                            allocations within a stage instead of the process
+                            RSS) and/or
+                            'cprofile' (a cProfile of every stage run)
+        BIKESHARE_METRICS - file to write all records to when the program
+                            exits, Prometheus text if it ends with .prom,
+                            JSON otherwise
+"""
+import atexit
+import cProfile
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:  # optional, /proc is read instead where it exists
+    psutil = None
+
+PROFILE_MODES = {mode.strip() for mode in os.environ.get('BIKESHARE_PROFILE', '').split(',') if mode.strip()}
+# keep at most that many records, the totals per stage are kept regardless
+MAX_RECORDS = 10000
+
+
+class StageRecord:
+    """ Measurements of one run of a stage. """
+    __slots__ = ('name', 'seconds', 'rows', 'bytes_read', 'bytes_loaded', 'memory_delta', 'memory_peak')
+
+    def __init__(self, name, rows=None, bytes_read=None):
+        self.name = name
+        self.seconds = None
+        self.rows = rows
+        self.bytes_read = bytes_read
+        self.bytes_loaded = None
+        self.memory_delta = None
+        self.memory_peak = None
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class Registry:
+    """ Keeps the records of all stage runs plus running totals per stage name. """
+
+    def __init__(self):
+        self.records = []
+        self.totals = {}
+        self.profile = None
+
+    def add(self, record):
+        if len(self.records) < MAX_RECORDS:
+            self.records.append(record)
+        total = self.totals.setdefault(record.name, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes_read': 0,
+                                                     'bytes_loaded': 0})
+        total['calls'] += 1
+        total['seconds'] += record.seconds
+        total['rows'] += record.rows or 0
+        total['bytes_read'] += record.bytes_read or 0
+        total['bytes_loaded'] += record.bytes_loaded or 0
+
+    def clear(self):
+        self.records.clear()
+        self.totals.clear()
+        self.profile = None
+
+    def to_json(self):
+        """ Returns all records and the totals per stage as JSON text. """
+        return json.dumps({'records': [record.as_dict() for record in self.records], 'totals': self.totals}, indent=2)
+
+    def to_prometheus(self):
+        """ Returns the totals per stage in the Prometheus text exposition format. """
+        metrics = (('bikeshare_stage_calls_total', 'counter', 'Number of runs of a stage.', 'calls'),
+                   ('bikeshare_stage_seconds_total', 'counter', 'Wall time spent in a stage.', 'seconds'),
+                   ('bikeshare_stage_rows_total', 'counter', 'Rows processed by a stage.', 'rows'),
+                   ('bikeshare_stage_bytes_read_total', 'counter', 'Bytes read from files by a stage.', 'bytes_read'),
+                   ('bikeshare_stage_bytes_loaded_total', 'counter', 'In-memory size of the data returned by a stage.',
+                    'bytes_loaded'))
+        lines = []
+        for metric, kind, help_text, key in metrics:
+            lines += ['# HELP {} {}'.format(metric, help_text), '# TYPE {} {}'.format(metric, kind)]
+            for name, total in sorted(self.totals.items()):
+                lines.append('{}{{stage="{}"}} {}'.format(metric, name, total[key]))
+        return '\n'.join(lines) + '\n'
+
+    def profile_stats(self, limit=30):
+        """ Returns the accumulated cProfile statistics as text (empty without 'cprofile' mode). """
+        if self.profile is None:
+            return ''
+        out = io.StringIO()
+        self.profile.stream = out
+        self.profile.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+
+REGISTRY = Registry()
+# only one cProfile can be active at a time - nested stages are part of the outer profile
+_profiling = False
+# the tracemalloc peak is reset by the outermost stage - nested stages report the peak since then
+_tracing = False
+
+
+def _current_rss():
+    """ Returns the current resident set size of the process in bytes (None if unknown). """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            # second field: resident pages
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+@contextmanager
+def stage(name, rows=None, bytes_read=None):
+    """ Measures a block of code as one run of a stage.
+        Args:
+            (str) name - stage name, e.g. 'load', 'parse', 'filter', 'aggregate'
+            (int) rows - rows processed, can also be set on the yielded record
+            (int) bytes_read - bytes read, can also be set on the yielded record
+        Yields:
+            StageRecord - filled in with time and memory when the block ends
+    """
+    record = StageRecord(name, rows, bytes_read)
+    try:
+        with _measure(record):
+            yield record
+    finally:
+        REGISTRY.add(record)
+
+
+@contextmanager
+def _measure(record):
+    """ Fills a record in with the time and memory (and profile) of a block of code. """
+    global _profiling, _tracing
+    tracing = 'tracemalloc' in PROFILE_MODES
+    outermost = False
+    if tracing:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if not _tracing:
+            tracemalloc.reset_peak()
+            _tracing = outermost = True
+        memory_before = tracemalloc.get_traced_memory()[0]
+    else:
+        memory_before = _current_rss()
+    profile = None
+    if 'cprofile' in PROFILE_MODES and not _profiling:
+        profile = cProfile.Profile()
+        profile.enable()
+        _profiling = True
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        if profile is not None:
+            profile.disable()
+            _profiling = False
+            if REGISTRY.profile is None:
+                REGISTRY.profile = pstats.Stats(profile)
+            else:
+                REGISTRY.profile.add(profile)
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            record.memory_delta, record.memory_peak = current - memory_before, peak - memory_before
+            if outermost:
+                _tracing = False
+        elif memory_before is not None:
+            memory_after = _current_rss()
+            record.memory_delta = None if memory_after is None else memory_after - memory_before
+
+
+def _count_result(record, result):
+    """ Adds rows (length) and in-memory size (columns of a DataFrame) of a result to a record. """
+    if hasattr(result, '__len__'):
+        record.rows = (record.rows or 0) + len(result)
+    if hasattr(result, 'memory_usage'):
+        record.bytes_loaded = (record.bytes_loaded or 0) + int(result.memory_usage(index=False).sum())
+
+
+def _instrumented_items(name, items):
+    """ Passes the items of a generator on and records them as one run of a stage once
+        the generator is used up (or closed): the time spent inside the generator and
+        rows/in-memory size of all items. The memory is not recorded, as the consumer of the
+        items allocates in between.
+    """
+    record = StageRecord(name)
+    record.seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                record.seconds += time.perf_counter() - start
+            _count_result(record, item)
+            yield item
+    finally:
+        REGISTRY.add(record)
+
+
+def instrumented(name):
+    """ Decorator recording every call of a function as a run of a stage.
+        If the function returns something with a length (e.g. a DataFrame) that
+        is recorded as the number of rows, for a DataFrame the size of its
+        materialized columns as the bytes loaded. A returned generator is
+        recorded over its iteration instead, see _instrumented_items.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            record = StageRecord(name)
+            try:
+                with _measure(record):
+                    result = func(*args, **kwargs)
+            except BaseException:
+                REGISTRY.add(record)
+                raise
+            if inspect.isgenerator(result):
+                # creating the generator costs nothing, its iteration is recorded instead
+                return _instrumented_items(name, result)
+            _count_result(record, result)
+            REGISTRY.add(record)
+            return result
+        return wrapper
+    return decorate
+
+
+def write_metrics(path, registry=REGISTRY):
+    """ Writes the records of a registry to a file, Prometheus text for *.prom, JSON otherwise. """
+    text = registry.to_prometheus() if path.endswith('.prom') else registry.to_json()
+    with open(path, 'w') as f:
+        f.write(text)
+    if registry.profile is not None:
+        registry.profile.dump_stats(os.path.splitext(path)[0] + '.pstats')
+
+
+if os.environ.get('BIKESHARE_METRICS'):
+    atexit.register(write_metrics, os.environ['BIKESHARE_METRICS'])
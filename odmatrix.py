@@ -0,0 +1,144 @@
+""" Sparse origin-destination (OD) matrix of bike trips.
+
+    Stations are referred to by integer ids 0...n-1. The matrix is built from
+    coordinate lists (COO: start id, end id) and kept in compressed sparse row
+    form (CSR): for station i, indices[indptr[i]:indptr[i+1]] are the end
+    stations of trips starting at i and data[...] the matching trip counts.
+    Only pairs that occur are stored, so every query below is O(nnz) or better.
+    The layout follows scipy.sparse.csr_matrix but needs nothing beyond numpy.
+"""
+import numpy as np
+
+
+def _top_k(counts, k):
+    """ Returns the positions of the k largest counts, largest first (ties in position order). """
+    k = min(k, len(counts))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    # stable sort on the negated counts keeps the position order on ties
+    return np.argsort(-counts, kind='stable')[:k]
+
+
+class ODMatrix:
+    """ Trip counts between start stations (rows) and end stations (columns) in CSR form. """
+    __slots__ = ('n', 'indptr', 'indices', 'data', '_transposed')
+
+    def __init__(self, n, indptr, indices, data):
+        self.n = n
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self._transposed = None
+
+    @classmethod
+    def from_coo(cls, start, end, n, counts=None):
+        """ Builds the matrix from coordinate lists, duplicate pairs are summed up.
+            Args:
+                (array) start - start station id per trip (or per pair)
+                (array) end - end station id per trip (or per pair)
+                (int) n - number of stations
+                (array) counts - optional count per pair, 1 per entry if omitted
+            Returns:
+                ODMatrix
+        """
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+        keys = start * n + end
+        if counts is None:
+            keys, data = np.unique(keys, return_counts=True)
+        else:
+            keys, inverse = np.unique(keys, return_inverse=True)
+            data = np.bincount(inverse.ravel(), weights=counts, minlength=len(keys))
+        rows = keys // max(n, 1)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))]).astype(np.int64)
+        return cls(n, indptr, keys % max(n, 1), data.astype(np.int64))
+
+    @classmethod
+    def empty(cls, n=0):
+        """ Returns a matrix without any trips. """
+        return cls(n, np.zeros(n + 1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    def relabel(self, ids, n):
+        """ Moves the matrix onto another station numbering.
+            Args:
+                (array) ids - new id of every current station id
+                (int) n - number of stations of the new numbering
+            Returns:
+                ODMatrix
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        start, end, counts = self.to_coo()
+        return ODMatrix.from_coo(ids[start], ids[end], n, counts)
+
+    def merge(self, other):
+        """ Returns the sum of two matrices on the same station numbering. """
+        if other.n != self.n:
+            raise ValueError('cannot merge OD matrices of {} and {} stations'.format(self.n, other.n))
+        start, end, counts = self.to_coo()
+        other_start, other_end, other_counts = other.to_coo()
+        return ODMatrix.from_coo(np.concatenate([start, other_start]), np.concatenate([end, other_end]),
+                                 self.n, np.concatenate([counts, other_counts]))
+
+    @property
+    def nnz(self):
+        """ Number of stored (start, end) pairs. """
+        return len(self.data)
+
+    def to_coo(self):
+        """ Returns the (start, end, count) coordinate lists of all stored pairs. """
+        rows = np.repeat(np.arange(self.n, dtype=np.int64), np.diff(self.indptr))
+        return rows, self.indices, self.data
+
+    def transpose(self):
+        """ Returns the matrix of trips from end to start station (cached). """
+        if self._transposed is None:
+            start, end, counts = self.to_coo()
+            self._transposed = ODMatrix.from_coo(end, start, self.n, counts)
+        return self._transposed
+
+    # --- directed queries
+    def count(self, start, end):
+        """ Returns the number of trips from station start to station end. """
+        lo, hi = self.indptr[start], self.indptr[start + 1]
+        pos = lo + np.searchsorted(self.indices[lo:hi], end)
+        return int(self.data[pos]) if pos < hi and self.indices[pos] == end else 0
+
+    def row(self, start):
+        """ Returns end station ids and counts of all trips starting at a station. """
+        lo, hi = self.indptr[start], self.indptr[start + 1]
+        return self.indices[lo:hi], self.data[lo:hi]
+
+    def top_destinations(self, start, k=1):
+        """ Returns the k most common (end station id, count) pairs of trips starting at a station. """
+        ends, counts = self.row(start)
+        return [(int(ends[i]), int(counts[i])) for i in _top_k(counts, k)]
+
+    def top_origins(self, end, k=1):
+        """ Returns the k most common (start station id, count) pairs of trips ending at a station. """
+        return self.transpose().top_destinations(end, k)
+
+    def top_trips(self, k=1):
+        """ Returns the k most common directed trips as (start id, end id, count) tuples. """
+        start, end, counts = self.to_coo()
+        return [(int(start[i]), int(end[i]), int(counts[i])) for i in _top_k(counts, k)]
+
+    # --- undirected and round trip queries
+    def round_trips(self):
+        """ Returns the diagonal: number of round trips per station as dense array. """
+        start, end, counts = self.to_coo()
+        diagonal = np.zeros(self.n, dtype=np.int64)
+        mask = start == end
+        diagonal[start[mask]] = counts[mask]
+        return diagonal
+
+    def undirected(self):
+        """ Returns the upper triangle of M + M^T with the diagonal counted once:
+            entry (a, b) with a <= b holds the trips a > b plus b > a, or the
+            round trips of a for a == b.
+        """
+        start, end, counts = self.to_coo()
+        return ODMatrix.from_coo(np.minimum(start, end), np.maximum(start, end), self.n, counts)
+
+    def top_pairs(self, k=1):
+        """ Returns the k most common station combinations regardless of direction as (a, b, count). """
+        return self.undirected().top_trips(k)
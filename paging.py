@@ -0,0 +1,118 @@
+""" Windowed paging through a loaded bikeshare table.
+
+    TableCursor keeps a position in a DataFrame and hands out pages as
+    positional slices (df.iloc[a:b]), which are views and cost the same on
+    the first and on the ten millionth row. Only the rows of the visible page
+    are ever formatted. Searching by station or by start time goes through
+    small indexes (row positions sorted by station code / by time) that are
+    built on first use, so repeated searches do not scan the table.
+"""
+import numpy as np
+import pandas as pd
+
+DEFAULT_PAGE_SIZE = 5
+
+
+class TableCursor:
+    """ A position in a DataFrame plus page, jump and search operations on it. """
+
+    def __init__(self, df, page_size=DEFAULT_PAGE_SIZE):
+        self.df = df
+        self.page_size = page_size
+        self.position = 0
+        self._station_index = {}
+        self._time_index = None
+
+    @property
+    def n_rows(self):
+        return len(self.df)
+
+    @property
+    def at_end(self):
+        return self.position >= self.n_rows
+
+    def jump(self, row):
+        """ Moves the cursor to a row position (clipped to the table). """
+        self.position = max(0, min(int(row), self.n_rows))
+        return self.position
+
+    def page(self, n=None):
+        """ Returns the next n rows (default: page size) and advances the cursor.
+            Near the end of the table the last n rows are returned instead.
+        """
+        n = n or self.page_size
+        start = self.position
+        if start + n > self.n_rows:
+            start = max(0, self.n_rows - n)
+        self.position = min(start + n, self.n_rows)
+        return self.df.iloc[start:self.position]
+
+    # --- indexes
+    def _codes(self, column):
+        """ Returns category codes and categories of a text column. """
+        values = self.df[column]
+        cat = values.array if isinstance(values.dtype, pd.CategoricalDtype) else pd.Categorical(values)
+        return np.asarray(cat.codes), cat.categories
+
+    def _station_positions(self, column):
+        """ Index of a station column: row positions grouped by station, plus group offsets. """
+        if column not in self._station_index:
+            codes, categories = self._codes(column)
+            order = np.argsort(codes, kind='stable')
+            offsets = np.searchsorted(codes[order], np.arange(len(categories) + 1))
+            self._station_index[column] = (order, offsets, {name: i for i, name in enumerate(categories)})
+        return self._station_index[column]
+
+    def _time_positions(self):
+        """ Index of 'Start Time': row positions sorted by time and the sorted times. """
+        if self._time_index is None:
+            times = np.asarray(self.df['Start Time'], dtype='datetime64[ns]')
+            order = np.argsort(times, kind='stable')
+            self._time_index = (order, times[order])
+        return self._time_index
+
+    # --- searching
+    def station_rows(self, station, columns=('Start Station', 'End Station')):
+        """ Returns the sorted row positions of trips starting or ending at a station. """
+        found = []
+        for column in columns:
+            order, offsets, position = self._station_positions(column)
+            code = position.get(station)
+            if code is not None:
+                found.append(order[offsets[code]:offsets[code + 1]])
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+    def time_rows(self, start, end=None):
+        """ Returns the sorted row positions of trips starting in [start, end).
+            Args:
+                start - anything pd.Timestamp understands, e.g. '2017-03-01 08:00'
+                end - end of the range, by default one hour after start
+        """
+        start = pd.Timestamp(start)
+        end = start + pd.Timedelta(hours=1) if end is None else pd.Timestamp(end)
+        order, times = self._time_positions()
+        lo, hi = np.searchsorted(times, [np.datetime64(start, 'ns'), np.datetime64(end, 'ns')])
+        return np.sort(order[lo:hi])
+
+    def find_next(self, rows):
+        """ Moves the cursor to the first of the given row positions at or after the
+            current position (wrapping around to the start), returns it or None.
+        """
+        if len(rows) == 0:
+            return None
+        i = np.searchsorted(rows, self.position)
+        return self.jump(rows[i] if i < len(rows) else rows[0])
+
+    # --- rendering
+    @staticmethod
+    def render(rows):
+        """ Formats only the given (visible) rows as text. """
+        return rows.to_string()
+
+    def overview(self, n=5):
+        """ Formats the first and last n rows of the table, like a condensed print(df). """
+        if self.n_rows <= 2 * n:
+            return self.render(self.df)
+        head = self.render(self.df.iloc[:n]).split('\n')
+        tail = self.render(self.df.iloc[-n:]).split('\n')[1:]
+        return '\n'.join(head + ['...'] + tail + ['', '[{} rows x {} columns]'.format(self.n_rows, len(self.df.columns))])
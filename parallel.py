@@ -0,0 +1,165 @@
+""" Multiprocess aggregation across cities and file partitions.
+
+    The work is split into independent tasks - one per city, and large csv
+    files additionally into byte ranges that start and end on line
+    boundaries. The partitions are sized so that there are a few tasks per
+    worker process, however few files there are. Each task runs in a worker
+    process, loads and filters only its part of the data and returns a
+    compact BikeshareAggregates (count arrays, duration sums, sparse OD
+    counts). The parent merges the partial results, which is cheap compared
+    to parsing the data.
+
+    If the columnar store of a file is already up to date, the month/weekday
+    filters are resolved by its time index up front and the workers read
+    only the matching row ranges of the memory-mapped store instead of
+    parsing csv text.
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import store
+from aggregates import BikeshareAggregates
+
+# upper and lower bound of the size of one csv partition in bytes
+PARTITION_BYTES = 64 * 1024**2
+MIN_PARTITION_BYTES = 1024**2
+# upper and lower bound of the number of rows of one store partition
+PARTITION_ROWS = 2 * 10**6
+MIN_PARTITION_ROWS = 20000
+# tasks planned per worker process, so workers that finish early pick up more work
+TASKS_PER_PROCESS = 3
+
+
+def csv_partitions(csv_path, partition_bytes=None):
+    """ Splits a csv file into byte ranges that start and end on line boundaries.
+        Args:
+            (str) csv_path - path of the csv file
+            (int) partition_bytes - approximate size of one range (default: PARTITION_BYTES)
+        Returns:
+            (list) (start, end) byte offsets, the header line is not part of any range
+    """
+    partition_bytes = partition_bytes or PARTITION_BYTES
+    size = os.path.getsize(csv_path)
+    with open(csv_path, 'rb') as f:
+        f.readline()
+        bounds = [f.tell()]
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + partition_bytes, size))
+            # move on to the start of the next line
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_csv_range(csv_path, start, end):
+    """ Parses the lines of a csv file between two byte offsets (plus the header line).
+        Args:
+            (str) csv_path - path of the csv file
+            (int) start, end - byte range as returned by csv_partitions
+        Returns:
+            df - Pandas DataFrame with parsed 'Start Time'/'End Time' columns
+    """
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        f.seek(start)
+        body = f.read(end - start)
+    return store.read_csv(io.BytesIO(header + body))
+
+
+def _aggregate_task(task):
+    """ Worker: loads one partition, applies the filters and returns its aggregates. """
+    kind, path, span, month, day, after = task
+    if kind == 'store':
+        # row ranges already resolved by the time index of the store (and the store
+        # of a segment holds only rows after its watermark)
+        city_store = store.CityStore.open(path)
+        return BikeshareAggregates.from_frame(
+            city_store.to_frame(np.concatenate([np.arange(lo, hi) for lo, hi in span])))
+    df = read_csv_range(path, *span)
+    return BikeshareAggregates.from_frame(store.filter_frame(df, month, day, after))
+
+
+def _partition_size(total, parts, lower, upper):
+    """ Returns the size of a partition when total is split into about parts pieces. """
+    return int(min(upper, max(lower, -(-total // max(parts, 1)))))
+
+
+def split_ranges(ranges, size):
+    """ Cuts (lo, hi) row ranges into groups of at most size rows.
+        Args:
+            (list) ranges - (lo, hi) row ranges
+            (int) size - number of rows per group
+        Returns:
+            (list) lists of (lo, hi) ranges, one per group
+    """
+    groups, group, n = [], [], 0
+    for lo, hi in ranges:
+        while lo < hi:
+            step = min(hi - lo, size - n)
+            group.append((lo, lo + step))
+            lo, n = lo + step, n + step
+            if n == size:
+                groups.append(group)
+                group, n = [], 0
+    if group:
+        groups.append(group)
+    return groups
+
+
+def plan_tasks(sources, month=None, day=None, cache_dir=None, processes=None):
+    """ Splits the aggregation of several city files into independent tasks,
+        about TASKS_PER_PROCESS per worker process.
+        Args:
+            (dict) sources - label (e.g. 'Chicago') -> csv path or list of segments
+            (int) month - month number 1...12, or None for no month filter
+            (int) day - weekday number 0 (Monday) ... 6, or None for no day filter
+            (int) processes - number of worker processes (default: number of CPUs)
+        Returns:
+            (list) task tuples for _aggregate_task: (kind, path, span, month, day, watermark) with
+                   span a list of row ranges of a store or the byte range of a csv partition
+    """
+    stores, csv_files = [], []
+    for source in sources.values():
+        for csv_path, after in store.segments(source):
+            city_store = store.open_store(csv_path, cache_dir, after)
+            if city_store is not None:
+                stores.append((city_store, city_store.row_ranges(month, day)))
+            else:
+                csv_files.append((csv_path, after))
+
+    n_tasks = (processes or os.cpu_count() or 1) * TASKS_PER_PROCESS
+    tasks = []
+    if stores:
+        rows = sum(hi - lo for _, ranges in stores for lo, hi in ranges)
+        size = _partition_size(rows, n_tasks, MIN_PARTITION_ROWS, PARTITION_ROWS)
+        for city_store, ranges in stores:
+            for group in split_ranges(ranges, size):
+                tasks.append(('store', city_store.path, group, None, None, None))
+    if csv_files:
+        total = sum(os.path.getsize(csv_path) for csv_path, _ in csv_files)
+        size = _partition_size(total, n_tasks, MIN_PARTITION_BYTES, PARTITION_BYTES)
+        for csv_path, after in csv_files:
+            for span in csv_partitions(csv_path, size):
+                tasks.append(('csv', csv_path, span, month, day, after))
+    return tasks
+
+
+def parallel_aggregates(sources, month=None, day=None, processes=None, cache_dir=None):
+    """ Computes the aggregates of several city files in a process pool.
+        Args:
+            (dict) sources - label (e.g. 'Chicago') -> csv path or list of segments
+            (int) month - month number 1...12, or None for no month filter
+            (int) day - weekday number 0 (Monday) ... 6, or None for no day filter
+            (int) processes - number of worker processes (default: number of CPUs)
+        Returns:
+            BikeshareAggregates - same result as BikeshareAggregates.from_frame on load_data
+    """
+    tasks = plan_tasks(sources, month, day, cache_dir, processes)
+    agg = BikeshareAggregates()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for part in pool.map(_aggregate_task, tasks):
+            agg = agg.merge(part)
+    return agg
@@ -0,0 +1,237 @@
+""" Memoization of selections and their statistics.
+
+    Users go back and forth between the same few city/month/day selections.
+    QueryCache keeps, per selection, what is expensive to recompute:
+
+        'rows'       the row positions of the selection in every store segment -
+                     the filtered frame is rebuilt from the memory-mapped stores
+                     without resolving the filters again, no copy of it is kept
+        'agg'        the BikeshareAggregates behind the statistics menu
+        'counts'     the count based aggregates answered by the data cube
+        'durations'  the DurationStats of the trip duration distribution
+
+    The key is (city, month, day, data version), where the data version is
+    derived from path, size and modification time of every file of the
+    selection, so results of files that changed or got new trips added (see
+    ingest.py) are never returned.
+
+    The memory tier is a least recently used cache bounded in bytes. The
+    optional disk tier writes every value next to the columnar stores, so a
+    selection is answered right away after a restart of the program as well;
+    it is bounded in bytes too, the least recently used selections are
+    removed first. Row positions are kept as int32 where they fit.
+
+    Environment variables:
+        BIKESHARE_QUERY_CACHE_MB      - size of the memory tier in MB (default 256, 0 to turn it off)
+        BIKESHARE_QUERY_CACHE_DISK    - 0 to turn the disk tier off (default 1)
+        BIKESHARE_QUERY_CACHE_DISK_MB - size of the disk tier in MB (default 1024)
+"""
+import hashlib
+import json
+import os
+import shutil
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+import store
+from aggregates import BikeshareAggregates
+from durations import DurationStats
+
+DEFAULT_MAX_BYTES = 256 * 1024**2
+DEFAULT_MAX_DISK_BYTES = 1024**3
+# classes of the values other than 'rows', all with save(path) and load(path)
+VALUE_TYPES = {'agg': BikeshareAggregates, 'counts': BikeshareAggregates, 'durations': DurationStats}
+
+
+def selection_key(city, month, day, sources):
+    """ Returns the cache key of a selection.
+        Args:
+            (str) city, month, day - the selection as entered, 'all' allowed
+            (dict) sources - label -> csv path or list of segments of the selected cities
+        Returns:
+            (str) hex digest of the selection and the current version of its files
+    """
+    version = {label: store.segments_key(source) for label, source in sources.items()}
+    # row positions are only valid for the layout of the stores they were taken from
+    text = json.dumps([city, month, day, version, store.STORE_VERSION], sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def default_directory():
+    """ Returns the directory of the disk tier inside the current cache directory of the stores. """
+    return os.path.join(store.CACHE_DIR, 'queries')
+
+
+def _nbytes(value):
+    """ Estimates the memory taken by a cached value. """
+    if isinstance(value, BikeshareAggregates):
+        arrays = (value.month_counts, value.weekday_counts, value.hour_counts, value.start_counts,
+                  value.end_counts, value.od.indptr, value.od.indices, value.od.data)
+        # names and dictionary entries at roughly 100 bytes each
+        entries = len(value.stations) + len(value.user_types) + len(value.genders or {}) + len(value.birth_years or {})
+        return sum(array.nbytes for array in arrays) + 100 * entries
+    if isinstance(value, DurationStats):
+        return value.nbytes()
+    return sum(rows.nbytes for rows in value if rows is not None)
+
+
+def _compact_rows(rows):
+    """ Returns an array of row positions as int32 if all of them fit, else unchanged. """
+    if rows is None or rows.dtype == np.int32 or (len(rows) and rows.max() >= 2**31):
+        return rows
+    return rows.astype(np.int32)
+
+
+class QueryCache:
+    """ LRU cache of selection results, bounded in bytes, with an optional disk tier. """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        """ Args:
+                (int) max_bytes - size limit of the memory tier
+                directory - where to keep the disk tier: a path, a function returning it
+                    (e.g. default_directory, called whenever the disk tier is used) or None
+                    for no disk tier
+                (int) max_disk_bytes - size limit of the disk tier
+        """
+        self.max_bytes = max_bytes
+        self._directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self):
+        """ Returns the current directory of the disk tier, None if there is none. """
+        return self._directory() if callable(self._directory) else self._directory
+
+    @directory.setter
+    def directory(self, directory):
+        self._directory = directory
+
+    @classmethod
+    def from_env(cls, cache_dir=None):
+        """ Returns a cache configured by the environment variables of the module docstring.
+            Args:
+                (str) cache_dir - directory holding the disk tier, by default the cache
+                    directory of the stores (store.CACHE_DIR) at the time of use
+        """
+        max_bytes = int(float(os.environ.get('BIKESHARE_QUERY_CACHE_MB', DEFAULT_MAX_BYTES / 1024**2)) * 1024**2)
+        disk = os.environ.get('BIKESHARE_QUERY_CACHE_DISK', '1') != '0'
+        max_disk_bytes = int(float(os.environ.get('BIKESHARE_QUERY_CACHE_DISK_MB',
+                                                  DEFAULT_MAX_DISK_BYTES / 1024**2)) * 1024**2)
+        directory = os.path.join(cache_dir, 'queries') if cache_dir else default_directory
+        return cls(max_bytes, directory if disk else None, max_disk_bytes)
+
+    def get(self, key, name):
+        """ Returns a cached value of a selection, None if there is none.
+            Args:
+                (str) key - selection key, see selection_key()
+                (str) name - 'rows' or one of VALUE_TYPES
+        """
+        if (key, name) in self.entries:
+            self.entries.move_to_end((key, name))
+            self.hits += 1
+            self._touch(key)
+            return self.entries[(key, name)][0]
+        value = self._read(key, name)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(key)
+        self._remember(key, name, value)
+        return value
+
+    def put(self, key, name, value):
+        """ Caches a value of a selection in memory and (if enabled) on disk. """
+        if name == 'rows':
+            value = [_compact_rows(rows) for rows in value]
+        self._remember(key, name, value)
+        try:
+            self._write(key, name, value)
+        except OSError:
+            pass
+
+    def clear(self):
+        """ Empties the memory tier. """
+        self.entries.clear()
+        self.size = 0
+
+    def _remember(self, key, name, value):
+        """ Adds a value to the memory tier, evicting the least recently used ones beyond max_bytes. """
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        if (key, name) in self.entries:
+            self.size -= self.entries.pop((key, name))[1]
+        self.entries[(key, name)] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    # --- disk tier
+    def _path(self, key, name):
+        return os.path.join(self.directory, key, name)
+
+    def _touch(self, key):
+        """ Marks a selection on disk as used, the least recently used ones are removed first. """
+        if self.directory is None:
+            return
+        try:
+            os.utime(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+    def _read(self, key, name):
+        if self.directory is None:
+            return None
+        path = self._path(key, name)
+        if name != 'rows':
+            value = VALUE_TYPES[name].load(path)[0]
+        else:
+            try:
+                with np.load(path + '.npz') as arrays:
+                    value = [arrays['rows{}'.format(i)] if 'rows{}'.format(i) in arrays else None
+                             for i in range(int(arrays['parts']))]
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                value = None
+        if value is None:
+            # a miss - and an unreadable (e.g. truncated) entry is removed
+            for extension in ('.npz', '.json'):
+                try:
+                    os.remove(path + extension)
+                except OSError:
+                    pass
+        return value
+
+    def _write(self, key, name, value):
+        directory = self.directory
+        if directory is None or _nbytes(value) > self.max_disk_bytes:
+            return
+        os.makedirs(os.path.join(directory, key), exist_ok=True)
+        path = os.path.join(directory, key, name)
+        if name != 'rows':
+            value.save(path)
+        else:
+            arrays = {'rows{}'.format(i): rows for i, rows in enumerate(value) if rows is not None}
+            store.write_atomic(path + '.npz', lambda f: np.savez(f, parts=len(value), **arrays), binary=True)
+        self._prune(directory)
+
+    def _prune(self, directory):
+        """ Removes the least recently used selections from disk beyond max_disk_bytes. """
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.is_dir():
+                size = sum(file.stat().st_size for file in os.scandir(entry.path) if file.is_file())
+                entries.append((entry.stat().st_mtime_ns, size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,774 @@
+""" Columnar on-disk cache for the bikeshare csv files.
+
+    Every csv listed in CITY_DATA is converted once into a directory of .npy
+    files (one per column) next to a small meta.json. 'Start Time' and
+    'End Time' are stored already parsed as datetime64, text columns such as
+    the station names or the user type are stored as integer category codes
+    plus their list of categories. Later loads simply memory-map those files
+    instead of parsing the csv again.
+
+    A converted file is only reused as long as path, size and modification
+    time of its source csv are unchanged - otherwise it is rebuilt.
+
+    Column types follow a fixed schema (see SCHEMA): station names are codes
+    into one station dictionary shared by all cities, trip durations are
+    int32 where that is lossless (whole seconds), years of birth nullable Int16 and all other
+    integers are downcast. memory_footprint() reports what this saves.
+
+    A city can consist of several files (see ingest.py): a source is either
+    a csv path or a list of (csv path, watermark) segments. Rows of a segment
+    starting at or before its watermark were already covered by the earlier
+    segments and are left out of its store.
+
+    Each store also carries a time index: the rows are stored sorted by
+    (month, weekday) of 'Start Time', and the offset of every month/weekday
+    block is kept in the meta data. A month and/or weekday filter is
+    therefore resolved to a handful of contiguous slices of every column, so
+    only the pages of the matching rows are ever read. The csv row number of
+    every stored row is kept as well, so loads still return the rows in the
+    order of the csv file.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import instrument
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# location of the converted files, can be moved with an environment variable
+CACHE_DIR = os.environ.get('BIKESHARE_CACHE', '.bikeshare_cache')
+# bump whenever the layout of a store directory changes
+STORE_VERSION = 5
+
+DATETIME_COLUMNS = ('Start Time', 'End Time')
+CATEGORY_COLUMNS = ('Start Station', 'End Station', 'User Type', 'Gender')
+STATION_COLUMNS = ('Start Station', 'End Station')
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# storage type of the known columns, everything else is stored as it comes
+# (integers downcast, text as categorical)
+SCHEMA = {'Start Time': 'datetime',
+          'End Time': 'datetime',
+          'Trip Duration': 'duration',
+          'Start Station': 'station',
+          'End Station': 'station',
+          'User Type': 'category',
+          'Gender': 'category',
+          'Birth Year': 'Int16'}
+# dtypes handed to read_csv so no object columns are created for these
+CSV_DTYPES = {'Start Station': 'category', 'End Station': 'category', 'User Type': 'category',
+              'Gender': 'category', 'Birth Year': 'float32'}
+
+MONTHS = ('january', 'february', 'march', 'april', 'may', 'june', 'july',
+          'august', 'september', 'october', 'november', 'december')
+DAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+def month_code(month):
+    """ Converts a month name into its number 1...12, 'all' (or None) gives None. """
+    if month in (None, 'all'):
+        return None
+    return MONTHS.index(month.lower()) + 1
+
+
+def day_code(day):
+    """ Converts a weekday name into its number 0 (Monday) ... 6 (Sunday), 'all' (or None) gives None. """
+    if day in (None, 'all'):
+        return None
+    return DAYS.index(day.lower())
+
+
+def time_codes(start_times):
+    """ Returns month (1...12) and weekday (0 = Monday) codes of an array of timestamps as int8 arrays. """
+    days = np.asarray(start_times, dtype='datetime64[ns]').astype('datetime64[D]')
+    month = days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    # 1970-01-01 was a Thursday (weekday 3)
+    weekday = (days.astype(np.int64) + 3) % 7
+    return month.astype(np.int8), weekday.astype(np.int8)
+
+
+def source_key(csv_path):
+    """ Identifies the current version of a csv file.
+        Args:
+            (str) csv_path - path of the csv file
+        Returns:
+            (dict) absolute path, size in bytes and modification time in ns
+    """
+    stat = os.stat(csv_path)
+    return {'path': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def segments(source):
+    """ Returns the (csv path, watermark) segments of a source.
+        Args:
+            source - a csv path, or a list of (csv path, watermark) pairs where the
+                watermark is a 'Start Time' string or None
+        Returns:
+            (list) (csv path, watermark) tuples
+    """
+    if isinstance(source, str):
+        return [(source, None)]
+    return [(path, after) for path, after in source]
+
+
+def segments_key(source):
+    """ Identifies the current version of all segments of a source, see source_key. """
+    return [dict(source_key(path), after=after) for path, after in segments(source)]
+
+
+def store_dir(csv_path, cache_dir=None, after=None):
+    """ Returns the directory holding the converted version of a csv file (cut at a watermark). """
+    abs_path = os.path.abspath(csv_path)
+    name_key = abs_path if after is None else '{}>{}'.format(abs_path, after)
+    digest = hashlib.sha1(name_key.encode('utf-8')).hexdigest()[:10]
+    name = os.path.splitext(os.path.basename(abs_path))[0]
+    return os.path.join(cache_dir or CACHE_DIR, '{}-{}'.format(name, digest))
+
+
+class CityStore:
+    """ Read-only access to one converted csv file.
+        Columns are opened lazily as memory-mapped arrays, so opening a store
+        costs next to nothing until a column is actually used.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.columns = [col['name'] for col in meta['columns']]
+        self.n_rows = meta['rows']
+        self._spec = {col['name']: col for col in meta['columns']}
+        # index arrays (e.g. the time index) are not part of the data columns
+        for name, file in meta.get('index_files', {}).items():
+            self._spec[name] = {'name': name, 'file': file, 'kind': 'numeric'}
+        self._arrays = {}
+        self._masks = {}
+
+    @classmethod
+    def open(cls, path):
+        """ Opens an existing store directory, returns None if it is missing or unreadable. """
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('version') != STORE_VERSION:
+            return None
+        return cls(path, meta)
+
+    def kind(self, name):
+        """ Returns the storage kind of a column: 'datetime', 'category', 'nullable' or 'numeric'. """
+        return self._spec[name]['kind']
+
+    def array(self, name):
+        """ Returns the raw (memory-mapped) array of a column - codes for categoricals. """
+        if name not in self._arrays:
+            file = os.path.join(self.path, self._spec[name]['file'])
+            self._arrays[name] = np.load(file, mmap_mode='r')
+        return self._arrays[name]
+
+    def mask(self, name):
+        """ Returns the (memory-mapped) missing-value mask of a nullable column. """
+        if name not in self._masks:
+            file = os.path.join(self.path, self._spec[name]['mask_file'])
+            self._masks[name] = np.load(file, mmap_mode='r')
+        return self._masks[name]
+
+    def categories(self, name):
+        """ Returns the list of categories of a categorical column.
+            Station columns share the station dictionary of the cache directory.
+        """
+        spec = self._spec[name]
+        if spec.get('dictionary'):
+            return station_dictionary(os.path.dirname(self.path), spec['dictionary_size'])
+        return spec['categories']
+
+    def series(self, name, rows=None):
+        """ Returns a column as pandas Series, optionally restricted to an array of row positions. """
+        values = self.take(self.array(name), rows)
+        if self.kind(name) == 'category':
+            values = pd.Categorical.from_codes(values, self.categories(name), validate=False)
+        elif self.kind(name) == 'nullable':
+            values = pd.arrays.IntegerArray(np.asarray(values), np.asarray(self.take(self.mask(name), rows)))
+        return pd.Series(values, name=name, copy=False)
+
+    def take(self, values, rows=None):
+        """ Returns the entries of a column (or mask) array at the given row positions,
+            all of them in csv order for None.
+        """
+        return values[self.array('__csv_order__') if rows is None else rows]
+
+    def select_rows(self, month=None, day=None):
+        """ Resolves month/weekday filters through the time index.
+            Args:
+                (int) month - month number 1...12, or None for no month filter
+                (int) day - weekday number 0 (Monday) ... 6, or None for no day filter
+            Returns:
+                array of matching row positions in csv order, or None if no filter applies
+        """
+        if month is None and day is None:
+            return None
+        with instrument.stage('filter') as record:
+            rows = self._select_rows(month, day)
+            record.rows = len(rows)
+        return rows
+
+    def row_ranges(self, month=None, day=None):
+        """ Returns the contiguous (lo, hi) ranges of stored rows matching month/weekday filters. """
+        offsets = self.meta['time_offsets']
+        if month is None and day is None:
+            return [(0, self.n_rows)] if self.n_rows else []
+        ranges = []
+        for m in range(1, 13) if month is None else [month]:
+            if day is None:
+                lo, hi = offsets[(m - 1) * 7], offsets[m * 7]
+            else:
+                lo, hi = offsets[(m - 1) * 7 + day], offsets[(m - 1) * 7 + day + 1]
+            if hi > lo:
+                ranges.append((lo, hi))
+        return ranges
+
+    def _select_rows(self, month, day):
+        ranges = self.row_ranges(month, day)
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        rows = np.concatenate([np.arange(lo, hi, dtype=np.int64) for lo, hi in ranges])
+        if month is None or day is None:
+            # several month/weekday blocks - restore the row order of the csv file across them
+            rows = rows[np.argsort(self.array('__csv_rows__')[rows], kind='stable')]
+        return rows
+
+    def to_frame(self, rows=None):
+        """ Materializes the store (or the given row positions of it) as DataFrame. """
+        return pd.DataFrame({name: self.series(name, rows) for name in self.columns}, copy=False)
+
+
+_dictionary_lock = threading.Lock()
+_dictionaries = {}
+
+
+def station_dictionary(cache_dir=None, min_size=0):
+    """ Returns the station dictionary shared by all stores of a cache directory.
+        Args:
+            (str) cache_dir - optional directory to use instead of CACHE_DIR
+            (int) min_size - reread the file if the loaded list is shorter than this
+        Returns:
+            (list) station names, the position of a name is its code
+    """
+    path = os.path.join(cache_dir or CACHE_DIR, 'stations.json')
+    names = _dictionaries.get(path)
+    if names is None or len(names) < min_size:
+        try:
+            with open(path) as f:
+                names = json.load(f)
+        except (OSError, ValueError):
+            names = []
+        _dictionaries[path] = names
+    return names
+
+
+def write_atomic(path, write, binary=False):
+    """ Writes a file under a temporary name and renames it into place in one step,
+        so readers never see a partly written file.
+        Args:
+            (str) path - name of the file
+            (callable) write - writes the contents, called with the open file
+            (bool) binary - open the file in binary mode
+    """
+    tmp = '{}.tmp{}-{}'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb' if binary else 'w') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def _locked_dictionary(path):
+    """ Holds the lock of a station dictionary file, across threads and (where fcntl
+        is available) across processes converting files into the same cache directory.
+    """
+    with _dictionary_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def extend_station_dictionary(names, cache_dir=None):
+    """ Adds station names that are not known yet to the shared dictionary.
+        Names are only ever appended, so codes of existing stores stay valid.
+        The file is read again and written under the dictionary lock, so
+        concurrent conversions never drop each other's names.
+        Args:
+            (iterable) names - station names to look up
+            (str) cache_dir - optional directory to use instead of CACHE_DIR
+        Returns:
+            (list) the updated dictionary
+    """
+    path = os.path.join(cache_dir or CACHE_DIR, 'stations.json')
+    with _locked_dictionary(path):
+        dictionary = list(station_dictionary(cache_dir, min_size=sys.maxsize))
+        known = set(dictionary)
+        new = sorted({str(name) for name in names} - known)
+        if new:
+            dictionary += new
+            write_atomic(path, lambda f: json.dump(dictionary, f))
+            _dictionaries[path] = dictionary
+        return dictionary
+
+
+def _code_dtype(n_categories):
+    """ Returns the smallest integer type holding category codes -1...n-1. """
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def _downcast(values):
+    """ Returns an integer array in the smallest integer type holding all its values. """
+    return np.asarray(pd.to_numeric(pd.Series(values), downcast='integer'))
+
+
+def parse_datetimes(values):
+    """ Parses timestamps with the known csv format, falling back to format inference. """
+    try:
+        return pd.to_datetime(values, format=DATETIME_FORMAT)
+    except (ValueError, TypeError):
+        return pd.to_datetime(values)
+
+
+def compact_durations(values):
+    """ Returns trip durations as int32 seconds if that is lossless, else unchanged as float64
+        (e.g. Washington records fractions of a second).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if not np.isnan(values).any() and (values == np.round(values)).all() and values.max(initial=0) < 2**31:
+        return values.astype(np.int32)
+    return values
+
+
+def apply_schema(df):
+    """ Converts the columns of a parsed csv DataFrame to the types of SCHEMA (in place).
+        Used for frames that do not come from a store (no cache, streaming).
+        Returns:
+            df - the same DataFrame
+    """
+    for name in df.columns:
+        kind = SCHEMA.get(name)
+        if kind == 'datetime':
+            df[name] = parse_datetimes(df[name])
+        elif kind == 'duration':
+            df[name] = compact_durations(df[name])
+        elif kind in ('station', 'category'):
+            df[name] = df[name].astype('category')
+        elif kind == 'Int16':
+            df[name] = df[name].round().astype('Int16')
+        elif pd.api.types.is_integer_dtype(df[name]):
+            df[name] = _downcast(df[name])
+        elif not pd.api.types.is_numeric_dtype(df[name]):
+            df[name] = df[name].astype('category')
+    return df
+
+
+def read_csv(source, **kwargs):
+    """ pd.read_csv with the dtypes of CSV_DTYPES assigned up front and SCHEMA applied. """
+    df = pd.read_csv(source, dtype=CSV_DTYPES, **kwargs)
+    if 'chunksize' in kwargs:
+        return (apply_schema(chunk) for chunk in df)
+    return apply_schema(df)
+
+
+def _encode_column(name, values, cache_dir=None):
+    """ Converts one csv column into its stored arrays and column spec.
+        Returns:
+            values array, missing-value mask (or None), column spec
+    """
+    kind = SCHEMA.get(name)
+    if kind == 'datetime':
+        return np.asarray(parse_datetimes(values), dtype='datetime64[ns]'), None, {'kind': 'datetime'}
+    if kind == 'duration':
+        return compact_durations(values), None, {'kind': 'numeric'}
+    if kind == 'Int16':
+        years = np.asarray(values, dtype=np.float64)
+        mask = np.isnan(years)
+        return np.where(mask, 0, np.round(years)).astype(np.int16), mask, {'kind': 'nullable'}
+    if kind == 'station':
+        cat = pd.Categorical(values)
+        dictionary = extend_station_dictionary(cat.categories, cache_dir)
+        position = {station: i for i, station in enumerate(dictionary)}
+        lookup = np.array([position[str(c)] for c in cat.categories] + [-1], dtype=np.int64)
+        codes = lookup[np.asarray(cat.codes)].astype(_code_dtype(len(dictionary)))
+        return codes, None, {'kind': 'category', 'dictionary': 'stations', 'dictionary_size': len(dictionary)}
+    if kind == 'category' or not pd.api.types.is_numeric_dtype(values):
+        cat = pd.Categorical(values)
+        codes = np.asarray(cat.codes).astype(_code_dtype(len(cat.categories)))
+        return codes, None, {'kind': 'category', 'categories': [str(c) for c in cat.categories]}
+    if pd.api.types.is_integer_dtype(values):
+        return _downcast(values), None, {'kind': 'numeric'}
+    return np.asarray(values), None, {'kind': 'numeric'}
+
+
+def memory_footprint(df):
+    """ Compares the memory taken by a DataFrame with a plain csv import of the same data.
+        Args:
+            df - Pandas DataFrame as returned by load_data
+        Returns:
+            (tuple) bytes in memory, estimated bytes with object-dtype strings
+                    and 64-bit numbers (what pd.read_csv produces by default)
+    """
+    compact = int(df.memory_usage(index=True, deep=True).sum())
+    plain = 128
+    for name in df.columns:
+        values = df[name]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # one 8 byte pointer plus one Python str object per row
+            codes = np.asarray(values.cat.codes)
+            counts = np.bincount(codes[codes >= 0], minlength=len(values.cat.categories))
+            sizes = np.array([sys.getsizeof(str(c)) for c in values.cat.categories], dtype=np.int64)
+            plain += 8 * len(values) + int(counts @ sizes) + 16 * int((codes < 0).sum())
+        elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+            plain += 8 * len(values)
+        else:
+            plain += int(values.memory_usage(index=False, deep=True))
+    return compact, plain
+
+
+def build_store(csv_path, cache_dir=None, after=None):
+    """ Converts a csv file into its columnar store and returns the opened store.
+        Args:
+            (str) csv_path - path of the csv file
+            (str) cache_dir - optional directory to use instead of CACHE_DIR
+            (str) after - optional watermark: only trips starting after it are stored
+        Returns:
+            CityStore - the freshly written store
+    """
+    target = store_dir(csv_path, cache_dir, after)
+    tmp = target + '.tmp{}'.format(os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    key = source_key(csv_path)
+    with instrument.stage('parse', bytes_read=key['size']) as record:
+        df = pd.read_csv(csv_path, dtype=CSV_DTYPES)
+        record.rows = len(df)
+    start_times = np.asarray(parse_datetimes(df['Start Time']), dtype='datetime64[ns]')
+    if after is not None:
+        keep = start_times > np.datetime64(pd.Timestamp(after), 'ns')
+        df, start_times = df[keep].reset_index(drop=True), start_times[keep]
+
+    # time index: rows are stored grouped by (month, weekday) block, in csv order within a block
+    month, weekday = time_codes(start_times)
+    block = (month.astype(np.int64) - 1) * 7 + weekday
+    order = np.argsort(block, kind='stable')
+    df, start_times = df.iloc[order].reset_index(drop=True), start_times[order]
+    meta = {'version': STORE_VERSION, 'source': key, 'after': after, 'rows': len(df), 'columns': [],
+            'max_start': str(pd.Timestamp(start_times.max())) if len(df) else None}
+    for i, name in enumerate(df.columns):
+        if name == 'Start Time':
+            values, mask, spec = start_times, None, {'kind': 'datetime'}
+        else:
+            values, mask, spec = _encode_column(name, df[name], cache_dir)
+        spec.update({'name': name, 'file': 'col{:02d}.npy'.format(i), 'dtype': str(values.dtype)})
+        np.save(os.path.join(tmp, spec['file']), values)
+        if mask is not None:
+            spec['mask_file'] = 'col{:02d}_mask.npy'.format(i)
+            np.save(os.path.join(tmp, spec['mask_file']), mask)
+        meta['columns'].append(spec)
+
+    # csv row number of every stored row, and the stored position of every csv row
+    position_dtype = np.int32 if len(df) < 2**31 else np.int64
+    csv_order = np.empty(len(df), dtype=position_dtype)
+    csv_order[order] = np.arange(len(df), dtype=position_dtype)
+    np.save(os.path.join(tmp, 'csv_rows.npy'), order.astype(position_dtype))
+    np.save(os.path.join(tmp, 'csv_order.npy'), csv_order)
+    meta['index_files'] = {'__csv_rows__': 'csv_rows.npy', '__csv_order__': 'csv_order.npy'}
+    meta['time_offsets'] = np.concatenate([[0], np.cumsum(np.bincount(block, minlength=12 * 7))]).tolist()
+
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # swap the new store in place of an outdated one
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+    return CityStore(target, meta)
+
+
+def open_store(csv_path, cache_dir=None, after=None):
+    """ Returns the store of a csv file if it exists and is up to date, otherwise None. """
+    store = CityStore.open(store_dir(csv_path, cache_dir, after))
+    if store is not None and store.meta['source'] == source_key(csv_path) and store.meta['after'] == after:
+        return store
+    return None
+
+
+def get_store(csv_path, cache_dir=None, after=None):
+    """ Returns the up-to-date store of a csv file, converting the file first if needed.
+        Args:
+            (str) csv_path - path of the csv file
+            (str) cache_dir - optional directory to use instead of CACHE_DIR
+            (str) after - optional watermark: only trips starting after it are stored
+        Returns:
+            CityStore - or None if the cache directory cannot be written
+    """
+    store = open_store(csv_path, cache_dir, after)
+    if store is not None:
+        return store
+    try:
+        return build_store(csv_path, cache_dir, after)
+    except OSError:
+        return None
+
+
+def filter_frame(df, month=None, day=None, after=None):
+    """ Applies month/weekday filters (as integer codes) and a watermark to an already loaded DataFrame. """
+    if month is None and day is None and after is None:
+        return df
+    with instrument.stage('filter', rows=len(df)):
+        month_no, weekday_no = time_codes(df['Start Time'])
+        mask = np.ones(len(df), dtype=bool)
+        if after is not None:
+            mask &= np.asarray(df['Start Time'], dtype='datetime64[ns]') > np.datetime64(pd.Timestamp(after), 'ns')
+        if month is not None:
+            mask &= month_no == month
+        if day is not None:
+            mask &= weekday_no == day
+        return df[mask].reset_index(drop=True)
+
+
+def read_city(source, month=None, day=None, cache_dir=None):
+    """ Loads a city csv file as DataFrame, going through the columnar cache when possible.
+        Month/weekday filters are pushed down to the time index of the store so
+        only matching rows are read.
+        Args:
+            source - path of the csv file, or a list of segments (see segments())
+            (int) month - month number 1...12, or None for no month filter
+            (int) day - weekday number 0 (Monday) ... 6, or None for no day filter
+        Returns:
+            df - Pandas DataFrame with parsed 'Start Time'/'End Time' columns
+    """
+    parts = select_parts({None: source}, month, day, cache_dir)
+    if parts is None:
+        frames = [filter_frame(read_csv(path), month, day, after) for path, after in segments(source)]
+        return frames[0] if len(frames) == 1 else concat_frames(frames)
+    return frame_from_parts(parts, label_column=None)
+
+
+def concat_frames(frames):
+    """ Concatenates DataFrames like pd.concat, but keeps categorical columns categorical:
+        pd.concat turns them into plain strings as soon as their categories differ,
+        so they are set to the union of the categories first.
+    """
+    names = []
+    for df in frames:
+        names += [name for name in df.columns if name not in names]
+    for name in names:
+        parts = [df[name] for df in frames if name in df.columns]
+        if len(parts) < 2 or not all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            continue
+        categories = parts[0].cat.categories
+        for part in parts[1:]:
+            categories = categories.union(part.cat.categories)
+        for df in frames:
+            if name in df.columns:
+                df[name] = df[name].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def select_parts(sources, month=None, day=None, cache_dir=None, rows=None):
+    """ Opens (or converts) the stores of all segments of several sources concurrently
+        and resolves the month/weekday filters on each of them.
+        Args:
+            (dict) sources - label (e.g. 'Chicago') -> csv path or list of segments
+            (int) month - month number 1...12, or None for no month filter
+            (int) day - weekday number 0 (Monday) ... 6, or None for no day filter
+            (list) rows - optional row positions per segment from an earlier call with
+                the same arguments (e.g. cached), the filters are not resolved again
+        Returns:
+            (list) (label, CityStore, row positions or None) parts for assemble(),
+            None if a store is not available
+    """
+    labelled = [(label, path, after) for label, source in sources.items() for path, after in segments(source)]
+    with ThreadPoolExecutor(max_workers=len(labelled)) as pool:
+        stores = list(pool.map(lambda part: get_store(part[1], cache_dir, part[2]), labelled))
+    if any(st is None for st in stores):
+        return None
+    if rows is None:
+        rows = [st.select_rows(month, day) for st in stores]
+    return [(label, st, part_rows) for (label, _, _), st, part_rows in zip(labelled, stores, rows)]
+
+
+def frame_from_parts(parts, label_column='City'):
+    """ Materializes (label, store, rows) parts as one DataFrame, see assemble(). """
+    if len(parts) == 1 and label_column is None:
+        _, st, rows = parts[0]
+        return st.to_frame(rows)
+    return assemble(parts, label_column)
+
+
+def _column_kind(stores, name):
+    """ Returns the common storage kind of a column across stores (None if they disagree). """
+    kinds = {st.kind(name) for st in stores if name in st.columns}
+    return kinds.pop() if len(kinds) == 1 else None
+
+
+def assemble(parts, label_column='City'):
+    """ Builds one DataFrame out of (label, store, rows) parts.
+        Every output column is allocated once at its final size and filled part
+        by part straight from the memory-mapped stores, so no intermediate
+        frames are created. Category codes are remapped onto the union of the
+        categories, columns missing in a part (e.g. 'Gender' for Washington) are
+        left as missing values of the column's own dtype.
+        Args:
+            (list) parts - (label, CityStore, row positions or None) tuples
+            (str) label_column - name of the categorical column holding the labels,
+                None for no such column (e.g. for the segments of one city)
+        Returns:
+            df - Pandas DataFrame with a clean RangeIndex
+    """
+    stores = [st for _, st, _ in parts]
+    sizes = [st.n_rows if rows is None else len(rows) for _, st, rows in parts]
+    bounds = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    n_total = int(bounds[-1])
+
+    columns = []
+    for st in stores:
+        columns += [name for name in st.columns if name not in columns]
+
+    data = {}
+    if label_column is not None:
+        # a label can appear in several parts, e.g. one per segment of a city
+        labels = []
+        for label, _, _ in parts:
+            if label not in labels:
+                labels.append(label)
+        label_codes = np.repeat(np.array([labels.index(label) for label, _, _ in parts], dtype=np.int32), sizes)
+        data[label_column] = pd.Categorical.from_codes(label_codes, labels, validate=False)
+    for name in columns:
+        kind = _column_kind(stores, name)
+        if kind == 'category':
+            shared = [st.categories(name) for st in stores if name in st.columns]
+            if all(cats == shared[0] for cats in shared):
+                # e.g. the station dictionary shared by all stores - codes are copied as they are
+                categories = shared[0]
+            else:
+                categories = sorted({c for cats in shared for c in cats})
+            position = {c: i for i, c in enumerate(categories)}
+            out = np.full(n_total, -1, dtype=_code_dtype(len(categories)))
+            for (_, st, rows), lo, hi in zip(parts, bounds[:-1], bounds[1:]):
+                if name not in st.columns:
+                    continue
+                codes = st.take(st.array(name), rows)
+                if st.categories(name) is categories:
+                    out[lo:hi] = codes
+                    continue
+                # last entry maps the missing-value code -1 onto itself
+                lookup = np.array([position[c] for c in st.categories(name)] + [-1], dtype=out.dtype)
+                out[lo:hi] = lookup[codes]
+            data[name] = pd.Categorical.from_codes(out, categories, validate=False)
+        elif kind == 'nullable':
+            dtype = np.result_type(*[st.array(name).dtype for st in stores if name in st.columns])
+            out = np.zeros(n_total, dtype=dtype)
+            mask = np.ones(n_total, dtype=bool)
+            for (_, st, rows), lo, hi in zip(parts, bounds[:-1], bounds[1:]):
+                if name in st.columns:
+                    out[lo:hi] = st.take(st.array(name), rows)
+                    mask[lo:hi] = st.take(st.mask(name), rows)
+            data[name] = pd.arrays.IntegerArray(out, mask)
+        elif kind in ('datetime', 'numeric'):
+            dtypes = [st.array(name).dtype for st in stores if name in st.columns]
+            dtype = np.result_type(*dtypes)
+            incomplete = len(dtypes) < len(stores)
+            if incomplete and kind == 'numeric' and dtype.kind in 'iub':
+                dtype = np.dtype(np.float64)
+            out = np.empty(n_total, dtype=dtype)
+            for (_, st, rows), lo, hi in zip(parts, bounds[:-1], bounds[1:]):
+                if name not in st.columns:
+                    out[lo:hi] = np.datetime64('NaT') if kind == 'datetime' else np.nan
+                else:
+                    out[lo:hi] = st.take(st.array(name), rows)
+            data[name] = out
+        else:
+            # stores disagree on the type of this column - let pandas sort it out
+            data[name] = pd.concat([st.series(name, rows) if name in st.columns else pd.Series([None] * size)
+                                    for (_, st, rows), size in zip(parts, sizes)], ignore_index=True)
+    return pd.DataFrame(data, copy=False)
+
+
+def read_cities(sources, month=None, day=None, cache_dir=None):
+    """ Loads several city csv files into a single DataFrame with a categorical 'City' column.
+        The stores are opened (or converted) concurrently in a thread pool and
+        the result is assembled in one go.
+        Args:
+            (dict) sources - label (e.g. 'Chicago') -> csv path or list of segments
+            (int) month - month number 1...12, or None for no month filter
+            (int) day - weekday number 0 (Monday) ... 6, or None for no day filter
+        Returns:
+            df - Pandas DataFrame of all cities, filtered by month and day
+    """
+    parts = select_parts(sources, month, day, cache_dir)
+    if parts is None:
+        # no usable cache - parse the csv files and concatenate once
+        frames = []
+        for label, source in sources.items():
+            df = read_city(source, month, day, cache_dir)
+            df.insert(0, 'City', pd.Categorical([label] * len(df)))
+            frames.append(df)
+        return concat_frames(frames)
+    return assemble(parts)
+
+
+def iter_city_chunks(source, month=None, day=None, chunksize=100000, label=None):
+    """ Streams a city csv file chunk by chunk without loading (or caching) the whole file.
+        Every chunk gets its timestamps parsed and the month/weekday filters
+        (and the watermark of its segment) applied before it is handed on.
+        Args:
+            source - path of the csv file, or a list of segments (see segments())
+            (int) month - month number 1...12, or None for no month filter
+            (int) day - weekday number 0 (Monday) ... 6, or None for no day filter
+            (int) chunksize - number of csv rows read per chunk
+            (str) label - optional value of a 'City' column inserted in front
+        Returns:
+            generator of Pandas DataFrames (empty chunks are skipped)
+    """
+    for csv_path, after in segments(source):
+        for df in read_csv(csv_path, chunksize=chunksize):
+            df = filter_frame(df, month, day, after)
+            if len(df) == 0:
+                continue
+            if label is not None:
+                df.insert(0, 'City', pd.Categorical([label] * len(df)))
+            yield df
+
+
+def iter_cities_chunks(sources, month=None, day=None, chunksize=100000):
+    """ Streams several city csv files one after the other, see iter_city_chunks.
+        Args:
+            (dict) sources - label (e.g. 'Chicago') -> csv path or list of segments
+        Returns:
+            generator of Pandas DataFrames with a 'City' column
+    """
+    for label, path in sources.items():
+        yield from iter_city_chunks(path, month, day, chunksize, label=label)
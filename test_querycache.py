@@ -0,0 +1,147 @@
+""" Tests of the query cache (querycache.py) and of the loads it serves.
+
+    Run with: python -m pytest -q
+    Every test works on small synthetic trip files in its own temporary
+    directory, which also holds the columnar stores and the disk tier.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bikeshare
+import ingest
+import querycache
+import store
+from aggregates import BikeshareAggregates
+
+
+def write_trips(path, n, first_day, days, seed=0, gender=True):
+    """ Writes a csv file of n random trips starting within days days after first_day. """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(first_day) + pd.to_timedelta(rng.integers(0, days * 86400, n), unit='s')
+    duration = rng.integers(60, 5000, n)
+    stations = np.array(['Station {}'.format(i) for i in range(40)])
+    data = {'Start Time': start.strftime('%Y-%m-%d %H:%M:%S'),
+            'End Time': (start + pd.to_timedelta(duration, unit='s')).strftime('%Y-%m-%d %H:%M:%S'),
+            'Trip Duration': duration,
+            'Start Station': stations[rng.integers(0, 40, n)],
+            'End Station': stations[rng.integers(0, 40, n)],
+            'User Type': rng.choice(['Subscriber', 'Customer', None], n, p=[.7, .28, .02])}
+    if gender:
+        data['Gender'] = rng.choice(['Male', 'Female', None], n, p=[.6, .3, .1])
+        years = rng.integers(1940, 2001, n).astype(float)
+        years[rng.random(n) < .1] = np.nan
+        data['Birth Year'] = years
+    pd.DataFrame(data).to_csv(path)
+    return str(path)
+
+
+@pytest.fixture
+def city_data(tmp_path, monkeypatch):
+    """ Points bikeshare.py at synthetic files of all three cities and a fresh cache directory. """
+    data = {'chicago': write_trips(tmp_path / 'chicago.csv', 3000, '2017-01-01', 90, seed=1),
+            'new york city': write_trips(tmp_path / 'new_york_city.csv', 4000, '2017-01-01', 90, seed=2),
+            'washington': write_trips(tmp_path / 'washington.csv', 2000, '2017-01-01', 90, seed=3, gender=False)}
+    monkeypatch.setattr(store, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(bikeshare, 'CITY_DATA', data)
+    monkeypatch.setattr(bikeshare, 'QUERY_CACHE', querycache.QueryCache(directory=querycache.default_directory))
+    return data
+
+
+def rows(n):
+    """ Returns a 'rows' value of n row positions (n * 4 bytes once stored as int32). """
+    return [np.arange(n, dtype=np.int64)]
+
+
+def entry_size(directory, key):
+    return sum(entry.stat().st_size for entry in os.scandir(os.path.join(directory, key)))
+
+
+def assert_same_aggregates(first, second):
+    for name in BikeshareAggregates.__slots__:
+        a, b = getattr(first, name), getattr(second, name)
+        if name == 'od':
+            for part in ('indptr', 'indices', 'data'):
+                np.testing.assert_array_equal(getattr(a, part), getattr(b, part))
+        elif isinstance(a, np.ndarray):
+            np.testing.assert_array_equal(a, b)
+        else:
+            assert a == b, name
+
+
+def test_memory_tier_evicts_least_recently_used_by_bytes():
+    cache = querycache.QueryCache(max_bytes=3 * 4000)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, 'rows', rows(1000))
+    assert cache.size == 3 * 4000
+    cache.get('a', 'rows')
+    cache.put('d', 'rows', rows(1000))
+    assert [key for key, _ in cache.entries] == ['c', 'a', 'd']
+    assert cache.get('b', 'rows') is None
+    # a value larger than the whole tier is not kept, nothing else is evicted for it
+    cache.put('e', 'rows', rows(4000))
+    assert cache.get('e', 'rows') is None
+    assert cache.size == 3 * 4000
+
+
+def test_disk_tier_prunes_least_recently_used_by_mtime(tmp_path):
+    cache = querycache.QueryCache(max_bytes=0, directory=str(tmp_path))
+    cache.put('a', 'rows', rows(1000))
+    cache.max_disk_bytes = int(2.5 * entry_size(tmp_path, 'a'))
+    cache.put('b', 'rows', rows(1000))
+    os.utime(tmp_path / 'a', ns=(10**18, 10**18))
+    os.utime(tmp_path / 'b', ns=(15 * 10**17, 15 * 10**17))
+    # a hit marks 'a' as used, so 'b' is the least recently used one when 'c' is written
+    assert cache.get('a', 'rows') is not None
+    cache.put('c', 'rows', rows(1000))
+    assert sorted(os.listdir(tmp_path)) == ['a', 'c']
+    np.testing.assert_array_equal(cache.get('c', 'rows')[0], np.arange(1000))
+
+
+def test_rows_are_stored_as_int32(tmp_path):
+    cache = querycache.QueryCache(directory=str(tmp_path))
+    cache.put('a', 'rows', rows(10) + [None])
+    value = querycache.QueryCache(directory=str(tmp_path)).get('a', 'rows')
+    assert value[0].dtype == np.int32 and value[1] is None
+
+
+def test_truncated_entry_is_a_miss_and_removed(tmp_path):
+    querycache.QueryCache(directory=str(tmp_path)).put('a', 'rows', rows(1000))
+    path = tmp_path / 'a' / 'rows.npz'
+    with open(path, 'r+b') as f:
+        f.truncate(path.stat().st_size // 2)
+    cache = querycache.QueryCache(directory=str(tmp_path))
+    assert cache.get('a', 'rows') is None
+    assert cache.misses == 1
+    assert not path.exists()
+
+
+def test_repeated_load_does_not_rewrite_rows(city_data):
+    bikeshare.load_data('chicago', 'february', 'all')
+    key = bikeshare.selection_key('chicago', 'february', 'all')
+    path = os.path.join(querycache.default_directory(), key, 'rows.npz')
+    os.utime(path, ns=(10**18, 10**18))
+    bikeshare.QUERY_CACHE.clear()
+    df = bikeshare.load_data('chicago', 'february', 'all')
+    assert os.stat(path).st_mtime_ns == 10**18
+    assert (df['Start Time'].dt.month == 2).all() and len(df) > 0
+
+
+def test_key_changes_after_add_file(city_data, tmp_path):
+    before = bikeshare.selection_key('chicago', 'april', 'all')
+    assert len(bikeshare.load_data('chicago', 'april', 'all')) == 0
+    added = ingest.add_file('chicago', write_trips(tmp_path / 'april.csv', 500, '2017-04-01', 30, seed=4), city_data)
+    assert added == 500
+    assert bikeshare.selection_key('chicago', 'april', 'all') != before
+    assert len(bikeshare.load_data('chicago', 'april', 'all')) == 500
+
+
+@pytest.mark.parametrize('city, month, day', [('chicago', 'all', 'all'), ('washington', 'march', 'all'),
+                                              ('all', 'february', 'monday')])
+def test_streaming_matches_in_memory(city_data, city, month, day):
+    streamed = BikeshareAggregates.from_chunks(bikeshare.load_data(city, month, day, chunksize=700))
+    loaded = BikeshareAggregates.from_frame(bikeshare.load_data(city, month, day))
+    assert streamed.trips > 0
+    assert_same_aggregates(streamed, loaded)